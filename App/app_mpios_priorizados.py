@@ -1,24 +1,165 @@
 
+import time
+# Inicio de esta ejecución del script (en la primera, incluye el tiempo de los imports)
+RUN_STARTED = time.perf_counter()
+
 import os
+import numpy as np
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import io
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-
-# Configure the page
-st.set_page_config(
-    page_title="Ficha Municipal",
-    page_icon="📋",
-    layout="wide"
-)
-
-def mostrar_paginacion_coincidencias(rec_code):
-    """Mostrar controles de paginación para coincidencias de una recomendación específica"""
-    pagina_actual = st.session_state.get(f'pagina_actual_coincidencias_{rec_code}', 1)
-    total_paginas = st.session_state.get(f'total_paginas_coincidencias_{rec_code}', 1)
+import json
+import gzip
+import hashlib
+import zipfile
+import importlib.util
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+# plotly.express y openpyxl se importan al dibujar el primer gráfico o generar el primer Excel
+from streamlit.logger import get_logger
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from artefactos import (DATA_DIR, DATA_PATH, DERIVED_COLUMNS, POLICY_CONFIDENCE_CUTOFF, POLICY_FLAG_COLUMN,
+                        SIMILARITY_GRID, SIMILARITY_STEP, ThresholdProfile, accumulate_similarity,
+                        add_policy_flag, as_threshold_profile, dataset_signature, find_artifacts,
+                        histograms_from_accumulators, load_artifact_histograms, optimize_dtypes,
+                        read_artifact_metadata, recommendation_table, snap_threshold, threshold_index,
+                        unit_table)
+from lugares import GEOMETRY_PATH, normalize_place_name
+
+logger = get_logger(__name__)
+# artefactos registra con logging: sus mensajes salen con el mismo formato que los de la app
+get_logger('artefactos')
+
+# GeoJSON publicados para el mapa (carpeta static/ junto al script, servida en app/static/)
+STATIC_MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'mapas')
+
+# Ranking: manejo de empates y criterios de desempate (columna, ascendente)
+TIE_METHODS = {
+    'Mínima (1, 2, 2, 4)': 'min',
+    'Densa (1, 2, 2, 3)': 'dense',
+}
+DEFAULT_TIE_METHOD = 'min'
+TIE_BREAKERS = {
+    'Similitud promedio (mayor primero)': ('Similitud_Promedio', False),
+    'IPM 2018 (mayor primero)': ('IPM_2018', False),
+    'IPM 2018 (menor primero)': ('IPM_2018', True),
+}
+PEER_PERCENTILE_COLUMNS = ['Percentil_Grupo_MDM', 'Percentil_PDET']
+
+# Recomendaciones priorizadas: etiqueta de prioridad de la tabla de recomendaciones
+PRIORITY_LABELS = ['Alta', 'High']
+
+# Descargas: el CSV se escribe por bloques de filas directamente a un buffer binario
+CSV_CHUNK_ROWS = 50_000
+EXCEL_MAX_ROWS = 1_048_575  # límite de filas de una hoja de Excel, sin contar el encabezado
+EXPORT_FORMATS = {
+    'Excel (.xlsx)': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'CSV (.csv)': ('csv', 'text/csv; charset=utf-8'),
+    'CSV comprimido (.csv.gz)': ('csv.gz', 'application/gzip'),
+    'CSV comprimido con ranking y diccionario (.zip)': ('zip', 'application/zip'),
+    'Parquet (.parquet)': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+# Memoria por sesión: las descargas preparadas viven en un almacén compartido del proceso,
+# con tope por sesión, tope total (se libera la menos usada) y liberación por inactividad
+SESSION_EXPORT_BUDGET_MB = 200
+EXPORT_STORE_BUDGET_MB = 1024
+SESSION_IDLE_SECONDS = 15 * 60
+# Páginas recordadas por sesión (una por recomendación y nivel); se olvidan las menos recientes
+MAX_PAGINATION_KEYS = 40
+PAGINATION_KEY_PREFIX = 'pagina_actual_coincidencias_'
+SESSION_USAGE_KEY = '_memoria_sesion'
+
+# Perfiles de umbrales por tema o recomendación, un JSON por perfil
+THRESHOLD_PRESETS_DIR = os.path.join(DATA_DIR, 'umbrales')
+NO_THRESHOLD_PRESET = 'Ninguno (umbral general)'
+
+# Perfil de arranque: PERFIL_ARRANQUE=1 streamlit run App/app_mpios_priorizados.py
+STARTUP_PROFILE = os.environ.get('PERFIL_ARRANQUE', '0') not in ('', '0')
+
+# Marcas de tiempo de esta ejecución: (etapa, segundos desde RUN_STARTED)
+profile_marks = []
+
+def profile_mark(stage):
+    """Registrar cuánto tardó la ejecución en llegar a una etapa"""
+    profile_marks.append((stage, time.perf_counter() - RUN_STARTED))
+
+@st.cache_resource
+def startup_record():
+    """Primer pintado de la primera ejecución del proceso (arranque en frío), compartido entre sesiones"""
+    return {}
+
+def record_first_paint():
+    """Marcar el primer pintado; en la primera ejecución del proceso se registra como arranque en frío"""
+    profile_mark('primer pintado')
+    record = startup_record()
+    if 'primer_pintado' not in record:
+        record['primer_pintado'] = profile_marks[-1][1]
+        logger.info(f"Arranque en frío: primer pintado a los {record['primer_pintado']:.2f} s")
+
+def render_startup_profile():
+    """Tiempos por etapa de esta ejecución (solo en modo perfil)"""
+    profile_mark('fin')
+    profile = pd.DataFrame(profile_marks, columns=['Etapa', 'Segundos'])
+    profile['Δ'] = profile['Segundos'].diff().fillna(profile['Segundos'])
+    logger.info("Perfil de ejecución: " + ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in profile_marks))
+    with st.sidebar.expander("⏱️ Perfil de arranque", expanded=True):
+        cold = startup_record().get('primer_pintado')
+        if cold is not None:
+            st.caption(f"Arranque en frío: primer pintado a los {cold:.2f} s")
+        st.dataframe(profile.round(3), hide_index=True, width='stretch')
+
+def _ir_a_pagina(pagina_key, pagina, state=None):
+    """Callback de los botones de paginación"""
+    state = st.session_state if state is None else state
+    state[pagina_key] = pagina
+    touch_pagination_key(pagina_key, state)
+
+def session_usage(state=None):
+    """Contadores de memoria de la sesión (visibles en la instrumentación y en la prueba de carga)"""
+    # state: estado de la sesión; por defecto st.session_state (la prueba de carga pasa el de cada usuario)
+    state = st.session_state if state is None else state
+    if SESSION_USAGE_KEY not in state:
+        state[SESSION_USAGE_KEY] = {'descarga_mb': 0.0, 'paginas': 0, 'desalojos': {}}
+    return state[SESSION_USAGE_KEY]
+
+def record_eviction(reason, count=1, state=None):
+    """Sumar desalojos de la sesión por motivo"""
+    evictions = session_usage(state)['desalojos']
+    evictions[reason] = evictions.get(reason, 0) + count
+
+def touch_pagination_key(pagina_key, state=None):
+    """Marcar una página como usada y olvidar las menos recientes si se supera el tope"""
+    state = st.session_state if state is None else state
+    recent = state.setdefault('_paginas_recientes', OrderedDict())
+    recent[pagina_key] = None
+    recent.move_to_end(pagina_key)
+
+    # Claves de página que quedaron sin registrar (p. ej. de una versión anterior de la app)
+    for key in list(state.keys()):
+        if key.startswith(PAGINATION_KEY_PREFIX) and key not in recent:
+            recent[key] = None
+            recent.move_to_end(key, last=False)
+
+    evicted = 0
+    while len(recent) > MAX_PAGINATION_KEYS:
+        stale_key, _ = recent.popitem(last=False)
+        state.pop(stale_key, None)
+        evicted += 1
+    if evicted:
+        record_eviction('paginacion', evicted, state)
+        logger.info(f"Sesión {current_session_id()}: {evicted} páginas olvidadas (tope {MAX_PAGINATION_KEYS})")
+    session_usage(state)['paginas'] = len(recent)
+
+def mostrar_paginacion_coincidencias(pagina_key, total_paginas, key_prefix):
+    """Mostrar controles de paginación para coincidencias de una recomendación específica.
+
+    Los botones usan callbacks: dentro de un fragmento, el clic solo re-ejecuta ese fragmento.
+    """
+    pagina_actual = st.session_state.get(pagina_key, 1)
 
     if total_paginas <= 1:
         return
@@ -34,9 +175,8 @@ def mostrar_paginacion_coincidencias(rec_code):
 
         # Botón anterior
         with cols[0]:
-            if st.button("◀", disabled=(pagina_actual <= 1), key=f"prev_page_coincidencias_{rec_code}"):
-                st.session_state[f'pagina_actual_coincidencias_{rec_code}'] = max(1, pagina_actual - 1)
-                st.rerun()
+            st.button("◀", disabled=(pagina_actual <= 1), key=f"prev_page_{key_prefix}",
+                      on_click=_ir_a_pagina, args=(pagina_key, max(1, pagina_actual - 1)))
 
         # Números de página como botones
         with cols[2]:
@@ -63,30 +203,650 @@ def mostrar_paginacion_coincidencias(rec_code):
                             f"<div style='background: #007bff; color: white; text-align: center; padding: 4px; border-radius: 4px; margin: 2px;'>{pagina}</div>",
                             unsafe_allow_html=True)
                     else:
-                        if st.button(str(pagina), key=f"page_coincidencias_{rec_code}_{pagina}"):
-                            st.session_state[f'pagina_actual_coincidencias_{rec_code}'] = pagina
-                            st.rerun()
+                        st.button(str(pagina), key=f"page_{key_prefix}_{pagina}",
+                                  on_click=_ir_a_pagina, args=(pagina_key, pagina))
 
         # Botón siguiente
         with cols[4]:
-            if st.button("▶", disabled=(pagina_actual >= total_paginas), key=f"next_page_coincidencias_{rec_code}"):
-                st.session_state[f'pagina_actual_coincidencias_{rec_code}'] = min(total_paginas, pagina_actual + 1)
-                st.rerun()
-
-# Load and cache data
-@st.cache_data
-def load_data():
-    """Load the pickle file and return the DataFrame"""
+            st.button("▶", disabled=(pagina_actual >= total_paginas), key=f"next_page_{key_prefix}",
+                      on_click=_ir_a_pagina, args=(pagina_key, min(total_paginas, pagina_actual + 1)))
+
+def recommendation_positions(codes, recommendations):
+    """Posición de cada código en la tabla de recomendaciones (-1 si no está)"""
+    known_codes = pd.Index(recommendations['recommendation_code'])
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        # Unir por los códigos de la categoría: solo se busca cada categoría una vez
+        by_category = known_codes.get_indexer(codes.cat.categories)
+        category_codes = codes.cat.codes.to_numpy()
+        return np.where(category_codes >= 0, by_category[category_codes], -1)
+    return known_codes.get_indexer(codes)
+
+def filter_by_threshold(frame, recommendations, sentence_threshold):
+    """Filas con similitud >= umbral de su recomendación (vector de umbrales unido por código)"""
+    profile = as_threshold_profile(sentence_threshold)
+    similarity = frame['sentence_similarity']
+    if profile.is_uniform:
+        return frame[similarity >= profile.default]
+
+    # Umbrales en la precisión de la columna, igual que en los histogramas
+    grid = SIMILARITY_GRID.astype(similarity.dtype)
+    by_recommendation = grid[profile.indices(recommendations)]
+    rec_rows = recommendation_positions(frame['recommendation_code'], recommendations)
+    row_thresholds = np.where(rec_rows >= 0, by_recommendation[rec_rows], grid[threshold_index(profile.default)])
+    return frame[similarity.to_numpy() >= row_thresholds]
+
+def memory_usage_mb(df):
+    """Memoria ocupada por el DataFrame en MB (incluye el contenido de los textos)"""
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+def read_dataset(data_path, policy_cutoff):
+    """Leer el pickle, compactar tipos y agregar la regla de política pública"""
+    df = pd.read_pickle(data_path)
+    memory_before = memory_usage_mb(df)
+    df = optimize_dtypes(df)
+    df = add_policy_flag(df, policy_cutoff)
+    memory_after = memory_usage_mb(df)
+    logger.info(f"Memoria del dataset: {memory_before:.1f} MB -> {memory_after:.1f} MB "
+                f"({1 - memory_after / memory_before:.0%} menos)")
+    return df
+
+@st.cache_resource(show_spinner=False)
+def start_data_load(data_path=DATA_PATH, policy_cutoff=POLICY_CONFIDENCE_CUTOFF):
+    """Empezar a leer el dataset en un hilo aparte; la barra lateral se dibuja mientras tanto"""
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='carga-datos')
+    future = executor.submit(read_dataset, data_path, policy_cutoff)
+    executor.shutdown(wait=False)
+    return future
+
+# Load and cache data (compartido entre sesiones y reruns; el DataFrame no se modifica)
+@st.cache_resource(show_spinner="Cargando datos...")
+def load_data(data_path=DATA_PATH, policy_cutoff=POLICY_CONFIDENCE_CUTOFF):
+    """Esperar la lectura en segundo plano y devolver el DataFrame"""
     try:
-        df = pd.read_pickle('Data/Similitudes Jerárquicas Final Econ 2.pkl')
-        return df
+        return start_data_load(data_path, policy_cutoff).result()
     except FileNotFoundError:
-        st.error("Archivo no encontrado. Verifique que existe 'Data/Similitudes Jerárquicas Final Econ 2.pkl'")
+        st.error(f"Archivo no encontrado. Verifique que existe '{data_path}'")
         return None
     except Exception as e:
         st.error(f"Error cargando datos: {str(e)}")
         return None
 
+# Solo se guardan las posiciones de las filas de política pública, no una segunda copia de los datos
+@st.cache_resource(show_spinner=False)
+def load_policy_positions(data_path=DATA_PATH, policy_cutoff=POLICY_CONFIDENCE_CUTOFF):
+    """Posiciones de las filas que cumplen la regla de política pública (compartido entre sesiones)"""
+    df = load_data(data_path, policy_cutoff)
+    return np.flatnonzero(df[POLICY_FLAG_COLUMN].to_numpy())
+
+def select_rows(df, include_policy_only, policy_positions, selected_department='Todos',
+                selected_municipality='Todos'):
+    """Filas del filtro de política y de lugar; se copian solo las filas elegidas"""
+    place = np.ones(len(df), dtype=bool)
+    if selected_department != 'Todos':
+        place &= (df['dpto'] == selected_department).to_numpy()
+    if selected_municipality != 'Todos':
+        place &= (df['mpio'] == selected_municipality).to_numpy()
+    rows = policy_positions[place[policy_positions]] if include_policy_only else np.flatnonzero(place)
+    return df if len(rows) == len(df) else df.iloc[rows]
+
+def select_sentences(data_path, recommendations, include_policy_only, sentence_threshold,
+                     selected_department='Todos', selected_municipality='Todos'):
+    """(dataset, filas del filtro de política y lugar, filas sobre el umbral); espera la lectura del dataset"""
+    df = load_data(data_path, POLICY_CONFIDENCE_CUTOFF)
+    if df is None:
+        st.stop()
+    filtered_df = select_rows(df, include_policy_only, load_policy_positions(data_path, POLICY_CONFIDENCE_CUTOFF),
+                              selected_department, selected_municipality)
+    return df, filtered_df, filter_by_threshold(filtered_df, recommendations, sentence_threshold)
+
+@st.cache_resource(show_spinner="Precalculando histogramas de similitud...")
+def load_similarity_histograms(data_path=DATA_PATH, policy_cutoff=POLICY_CONFIDENCE_CUTOFF):
+    """Histogramas de similitud por (mpio, recomendación): de los artefactos precalculados si están al día"""
+    artifact_dir = find_artifacts(data_path, policy_cutoff)
+    if artifact_dir is not None:
+        logger.info(f"Histogramas leídos de {artifact_dir}")
+        return load_artifact_histograms(artifact_dir)
+
+    df = load_data(data_path, policy_cutoff)
+    unit_codes, units = unit_table(df)
+    rec_codes, recommendations = recommendation_table(df)
+    accumulators = accumulate_similarity(unit_codes, rec_codes, df['sentence_similarity'].to_numpy(),
+                                         df[POLICY_FLAG_COLUMN].to_numpy(), len(units), len(recommendations))
+    return histograms_from_accumulators(units, recommendations, accumulators)
+
+@dataclass
+class ParagraphIndex:
+    """Adyacencia tipo CSR párrafo -> (oración, recomendación), agrupada por municipio y página"""
+    unit_ptr: np.ndarray       # (unidades + 1): rango de párrafos de cada unidad
+    paragraph_ids: np.ndarray  # paragraph_id de cada párrafo, ordenados por (unidad, página, párrafo)
+    page_codes: np.ndarray     # posición de la página de cada párrafo en `pages`
+    pages: np.ndarray          # valores de page_number ordenados
+    row_ptr: np.ndarray        # (párrafos + 1): rango de filas de cada párrafo
+    rows: np.ndarray           # posición de la fila en el DataFrame, por (recomendación, similitud desc)
+    rec_codes: np.ndarray      # posición de la recomendación de cada fila en la tabla de recomendaciones
+    similarity: np.ndarray     # similitud de oración de cada fila
+    policy: np.ndarray         # la fila cumple la regla de política pública
+
+    def unit_pages(self, unit):
+        """Páginas con texto cruzado en la unidad, en orden"""
+        codes = self.page_codes[self.unit_ptr[unit]:self.unit_ptr[unit + 1]]
+        return self.pages[np.unique(codes)]
+
+    def page_paragraphs(self, unit, page):
+        """Párrafos de una página de la unidad (búsqueda binaria dentro del municipio)"""
+        start, end = self.unit_ptr[unit], self.unit_ptr[unit + 1]
+        page_code = np.searchsorted(self.pages, page)
+        codes = self.page_codes[start:end]
+        first, last = np.searchsorted(codes, [page_code, page_code + 1])
+        return np.arange(start + first, start + last)
+
+    def paragraph_matches(self, paragraph, include_policy_only, threshold_indices):
+        """Filas del párrafo sobre el umbral de su recomendación; la primera de cada recomendación es la mejor"""
+        start, end = self.row_ptr[paragraph], self.row_ptr[paragraph + 1]
+        rec_codes = self.rec_codes[start:end]
+        similarity = self.similarity[start:end]
+        keep = similarity >= SIMILARITY_GRID.astype(similarity.dtype)[threshold_indices[rec_codes]]
+        if include_policy_only:
+            keep &= self.policy[start:end]
+        return self.rows[start:end][keep], rec_codes[keep], similarity[keep]
+
+@st.cache_resource(show_spinner="Indexando párrafos...")
+def load_paragraph_index(data_path=DATA_PATH, policy_cutoff=POLICY_CONFIDENCE_CUTOFF):
+    """Construir una vez el índice párrafo -> recomendaciones de todos los municipios"""
+    df = load_data(data_path, policy_cutoff)
+    histograms = load_similarity_histograms(data_path, policy_cutoff)
+
+    # Mismas unidades y recomendaciones que los histogramas
+    unit_codes = df.groupby(['mpio', 'dpto'], observed=True, sort=True).ngroup().to_numpy()
+    rec_codes = recommendation_positions(df['recommendation_code'], histograms.recommendations)
+    paragraph_codes, paragraph_values = pd.factorize(df['paragraph_id'], sort=True)
+    page_codes, page_values = pd.factorize(df['page_number'], sort=True)
+    similarity = df['sentence_similarity'].to_numpy()
+
+    valid = (unit_codes >= 0) & (rec_codes >= 0) & (paragraph_codes >= 0) & (page_codes >= 0) & ~np.isnan(similarity)
+    rows = np.flatnonzero(valid)
+    # Orden (unidad, página, párrafo, recomendación, similitud descendente); lexsort usa la última llave primero
+    order = np.lexsort((-similarity[rows], rec_codes[rows], paragraph_codes[rows],
+                        page_codes[rows], unit_codes[rows]))
+    rows = rows[order]
+
+    keys = np.column_stack([unit_codes[rows], page_codes[rows], paragraph_codes[rows]])
+    starts = np.flatnonzero(np.concatenate([[True], np.any(keys[1:] != keys[:-1], axis=1)])) if len(rows) else np.array([], dtype=int)
+    paragraph_units = keys[starts, 0]
+
+    return ParagraphIndex(
+        unit_ptr=np.searchsorted(paragraph_units, np.arange(len(histograms.units) + 1)),
+        paragraph_ids=np.asarray(paragraph_values)[keys[starts, 2]],
+        page_codes=keys[starts, 1].astype('int32'),
+        pages=np.asarray(page_values),
+        row_ptr=np.append(starts, len(rows)),
+        rows=rows.astype('int32' if len(df) < 2 ** 31 else 'int64'),
+        rec_codes=rec_codes[rows].astype('int32'),
+        similarity=similarity[rows],
+        policy=df[POLICY_FLAG_COLUMN].to_numpy()[rows]
+    )
+
+def create_paragraph_matches_data(df, paragraph_index, recommendations, paragraph, include_policy_only,
+                                  threshold_indices):
+    """Recomendaciones que cruzan con un párrafo, de mayor a menor similitud"""
+    rows, rec_codes, similarity = paragraph_index.paragraph_matches(paragraph, include_policy_only,
+                                                                    threshold_indices)
+    # Las filas vienen ordenadas por recomendación y similitud: la primera de cada grupo es la máxima
+    recs, first, counts = np.unique(rec_codes, return_index=True, return_counts=True)
+    matches = pd.DataFrame({
+        'Código': recommendations['recommendation_code'].astype(str).to_numpy()[recs],
+        'Recomendación': recommendations['recommendation_text'].astype(str).to_numpy()[recs],
+        'Similitud_Max': similarity[first].astype('float64'),
+        'Oraciones': counts,
+        'Similitud_Párrafo': df['paragraph_similarity'].to_numpy()[rows[first]].astype('float64')
+    })
+    return matches.sort_values(['Similitud_Max', 'Código'], ascending=[False, True]).reset_index(drop=True)
+
+def list_dataset_versions(data_dir=DATA_DIR):
+    """Versiones disponibles del dataset: un archivo .pkl por versión en la carpeta de datos"""
+    if not os.path.isdir(data_dir):
+        return [DATA_PATH]
+    versions = sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir) if name.endswith('.pkl'))
+    return versions or [DATA_PATH]
+
+@st.cache_resource(show_spinner=False)
+def load_artifact_metadata(data_path, policy_cutoff):
+    """metadata.json de los artefactos de la versión si están al día, o None (se lee una vez por proceso)"""
+    artifact_dir = find_artifacts(data_path, policy_cutoff)
+    return None if artifact_dir is None else read_artifact_metadata(artifact_dir)
+
+@st.cache_data(show_spinner=False)
+def load_place_lists(data_path, policy_cutoff):
+    """Municipios por departamento: del metadata.json de los artefactos si están al día, si no de los datos"""
+    metadata = load_artifact_metadata(data_path, policy_cutoff)
+    if metadata is not None and 'municipios_por_departamento' in metadata:
+        return metadata['municipios_por_departamento']
+
+    logger.info("Sin artefactos precalculados: departamento y municipio esperan la carga de datos "
+                "(App/precalcular_artefactos.py)")
+    df = load_data(data_path, policy_cutoff)
+    if df is None:
+        return None
+    units = df[['dpto', 'mpio']].drop_duplicates()
+    return {str(dpto): sorted(group['mpio'].astype(str))
+            for dpto, group in units.groupby(units['dpto'].astype(str), sort=True)}
+
+def implemented_by_unit(histograms, include_policy_only, sentence_threshold):
+    """Matriz (unidades, recomendaciones) con True si hay al menos una oración sobre el umbral"""
+    # Un umbral por recomendación: se toma de cada columna el punto de la grilla que le corresponde
+    indices = as_threshold_profile(sentence_threshold).indices(histograms.recommendations)
+    return histograms.at_least[include_policy_only][:, np.arange(len(indices)), indices] > 0
+
+def priority_mask(recommendations):
+    """Recomendaciones priorizadas (etiqueta Alta/High), en el orden de la tabla de recomendaciones"""
+    return recommendations['recommendation_priority_label'].isin(PRIORITY_LABELS).to_numpy(dtype=bool)
+
+@dataclass
+class ImplementationKpis:
+    """Recomendaciones implementadas (todas y prioritarias) por municipio en cada umbral de la grilla"""
+    implemented: dict           # {solo_politica: array (unidades, umbrales)}
+    priority_implemented: dict  # {solo_politica: array (unidades, umbrales)}
+    priority: np.ndarray        # máscara de recomendaciones priorizadas
+    total_recommendations: int
+    total_priority: int
+
+    def counts(self, histograms, include_policy_only, sentence_threshold):
+        """(implementadas, prioritarias implementadas) de cada unidad para un umbral o perfil de umbrales"""
+        profile = as_threshold_profile(sentence_threshold)
+        if profile.is_uniform:
+            k = threshold_index(profile.default)
+            return self.implemented[include_policy_only][:, k], self.priority_implemented[include_policy_only][:, k]
+        implemented = implemented_by_unit(histograms, include_policy_only, profile)
+        return implemented.sum(axis=1), implemented[:, self.priority].sum(axis=1)
+
+    def unit_counts(self, histograms, unit_positions, include_policy_only, sentence_threshold):
+        """(implementadas, prioritarias implementadas) de un grupo de unidades, sin contar dos veces una recomendación"""
+        if len(unit_positions) == 1:
+            implemented, priority_implemented = self.counts(histograms, include_policy_only, sentence_threshold)
+            return int(implemented[unit_positions[0]]), int(priority_implemented[unit_positions[0]])
+        reached = implemented_by_unit(histograms, include_policy_only, sentence_threshold)[unit_positions].any(axis=0)
+        return int(reached.sum()), int(reached[self.priority].sum())
+
+@st.cache_resource(show_spinner=False)
+def load_implementation_kpis(data_path=DATA_PATH, policy_cutoff=POLICY_CONFIDENCE_CUTOFF):
+    """KPIs de todos los municipios y umbrales en una pasada sobre los histogramas; totales de la tabla de recomendaciones"""
+    histograms = load_similarity_histograms(data_path, policy_cutoff)
+    priority = priority_mask(histograms.recommendations)
+    implemented, priority_implemented = {}, {}
+    for include_policy_only in [False, True]:
+        reached = histograms.at_least[include_policy_only] > 0  # (unidades, recomendaciones, umbrales)
+        implemented[include_policy_only] = reached.sum(axis=1, dtype='int32')
+        priority_implemented[include_policy_only] = reached[:, priority].sum(axis=1, dtype='int32')
+    return ImplementationKpis(implemented=implemented, priority_implemented=priority_implemented,
+                              priority=priority, total_recommendations=len(histograms.recommendations),
+                              total_priority=int(priority.sum()))
+
+def load_threshold_presets(presets_dir=THRESHOLD_PRESETS_DIR):
+    """Perfiles de umbrales guardados: {nombre: {'por_tema': {...}, 'por_recomendacion': {...}}}"""
+    presets = {}
+    if not os.path.isdir(presets_dir):
+        return presets
+    for file_name in sorted(os.listdir(presets_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(presets_dir, file_name), encoding='utf-8') as f:
+                preset = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Perfil de umbrales ignorado ({file_name}): {e}")
+            continue
+        presets[preset.get('nombre', file_name[:-len('.json')])] = preset
+    return presets
+
+def save_threshold_preset(name, by_topic, by_code, presets_dir=THRESHOLD_PRESETS_DIR):
+    """Guardar un perfil de umbrales como JSON; devuelve la ruta del archivo"""
+    os.makedirs(presets_dir, exist_ok=True)
+    file_name = ''.join(c if c.isalnum() else '_' for c in normalize_place_name(name).lower()) or 'perfil'
+    path = os.path.join(presets_dir, f"{file_name}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'nombre': name, 'por_tema': by_topic, 'por_recomendacion': by_code}, f,
+                  ensure_ascii=False, indent=2)
+    return path
+
+def threshold_overrides(table, key_column):
+    """Umbrales definidos en una tabla editable, ajustados a la grilla ({clave: umbral})"""
+    defined = table.dropna(subset=['Umbral'])
+    return {str(key): snap_threshold(value) for key, value in zip(defined[key_column], defined['Umbral'])}
+
+def build_threshold_profile(sentence_threshold, by_topic, by_code, name=''):
+    """Perfil hashable (sirve de llave de caché) a partir de los umbrales por tema y por código"""
+    return ThresholdProfile(
+        default=snap_threshold(sentence_threshold),
+        by_topic=tuple(sorted((str(k), snap_threshold(v)) for k, v in by_topic.items())),
+        by_code=tuple(sorted((str(k), snap_threshold(v)) for k, v in by_code.items())),
+        name=name
+    )
+
+def _guardar_perfil_umbrales(by_topic, by_code):
+    """Callback del botón de guardar perfil: escribe el JSON y lo deja seleccionado"""
+    name = st.session_state.get('threshold_preset_name', '').strip()
+    if not name:
+        return
+    save_threshold_preset(name, by_topic, by_code)
+    st.session_state['threshold_preset'] = name
+
+def render_threshold_profile_editor(recommendations, sentence_threshold):
+    """Editor de umbrales por tema y por recomendación en la barra lateral; devuelve el perfil activo"""
+    presets = load_threshold_presets()
+    with st.sidebar.expander("🎚️ Umbrales por tema o recomendación"):
+        if st.session_state.get('threshold_preset') not in [NO_THRESHOLD_PRESET] + list(presets):
+            st.session_state['threshold_preset'] = NO_THRESHOLD_PRESET
+        preset_name = st.selectbox(
+            "Perfil:",
+            options=[NO_THRESHOLD_PRESET] + list(presets),
+            key='threshold_preset',
+            help="Los temas o recomendaciones sin umbral propio usan el umbral general"
+        )
+        preset = presets.get(preset_name, {})
+        preset_topics = preset.get('por_tema', {})
+        preset_codes = preset.get('por_recomendacion', {})
+
+        number_column = st.column_config.NumberColumn(min_value=0.0, max_value=1.0, step=SIMILARITY_STEP,
+                                                      format="%.2f")
+        by_topic = {}
+        if 'recommendation_topic' in recommendations.columns:
+            topics = sorted(recommendations['recommendation_topic'].dropna().astype(str).unique())
+            topic_table = pd.DataFrame({'Tema': topics,
+                                        'Umbral': [preset_topics.get(topic) for topic in topics]}, dtype=object)
+            topic_table['Umbral'] = topic_table['Umbral'].astype('float64')
+            by_topic = threshold_overrides(st.data_editor(
+                topic_table, hide_index=True, disabled=['Tema'], column_config={'Umbral': number_column},
+                key=f"threshold_topics_{preset_name}"), 'Tema')
+
+        codes = recommendations['recommendation_code'].astype(str)
+        code_table = pd.DataFrame({'Código': codes,
+                                   'Umbral': [preset_codes.get(code) for code in codes]}, dtype=object)
+        code_table['Umbral'] = code_table['Umbral'].astype('float64')
+        by_code = threshold_overrides(st.data_editor(
+            code_table, hide_index=True, disabled=['Código'], column_config={'Umbral': number_column},
+            key=f"threshold_codes_{preset_name}"), 'Código')
+
+        st.text_input("Guardar como:", key='threshold_preset_name', placeholder="Nombre del perfil")
+        st.button("💾 Guardar perfil", on_click=_guardar_perfil_umbrales, args=(by_topic, by_code),
+                  width='stretch')
+
+    name = preset_name if preset_name != NO_THRESHOLD_PRESET else ''
+    return build_threshold_profile(sentence_threshold, by_topic, by_code, name)
+
+def version_unit_summary(data_path, policy_cutoff, include_policy_only, sentence_threshold, tie_method, tie_breakers):
+    """Recomendaciones implementadas y posición de cada municipio en una versión del dataset"""
+    ranking = compute_ranking(data_path, policy_cutoff, include_policy_only, sentence_threshold,
+                              tie_method, tie_breakers)
+    summary = ranking.table[['Municipio', 'Departamento', 'Recomendaciones_Implementadas', 'Ranking']].copy()
+    summary.columns = ['mpio', 'dpto', 'Recomendaciones', 'Posicion']
+    summary[['mpio', 'dpto']] = summary[['mpio', 'dpto']].astype(str)
+
+    # Pares (municipio, recomendación) implementados, para cruzar entre versiones
+    histograms = load_similarity_histograms(data_path, policy_cutoff)
+    unit_idx, rec_idx = np.nonzero(implemented_by_unit(histograms, include_policy_only, sentence_threshold))
+    pairs = pd.DataFrame({
+        'mpio': histograms.units['mpio'].astype(str).to_numpy()[unit_idx],
+        'dpto': histograms.units['dpto'].astype(str).to_numpy()[unit_idx],
+        'recommendation_code': histograms.recommendations['recommendation_code'].astype(str).to_numpy()[rec_idx]
+    })
+    return summary, pairs
+
+@st.cache_data(show_spinner="Comparando versiones...", max_entries=64)
+def compute_ranking_movement(base_path, other_path, policy_cutoff, include_policy_only, sentence_threshold,
+                             tie_method=DEFAULT_TIE_METHOD, tie_breakers=()):
+    """Cambio de posición y recomendaciones nuevas o perdidas por municipio entre dos versiones"""
+    base_summary, base_pairs = version_unit_summary(base_path, policy_cutoff, include_policy_only,
+                                                    sentence_threshold, tie_method, tie_breakers)
+    other_summary, other_pairs = version_unit_summary(other_path, policy_cutoff, include_policy_only,
+                                                      sentence_threshold, tie_method, tie_breakers)
+
+    # Recomendaciones nuevas (solo en la versión comparada) y perdidas (solo en la base)
+    pairs = base_pairs.merge(other_pairs, on=['mpio', 'dpto', 'recommendation_code'], how='outer', indicator=True)
+    changes = pd.crosstab([pairs['mpio'], pairs['dpto']], pairs['_merge'])
+    changes = changes.reindex(columns=['left_only', 'right_only'], fill_value=0)
+    changes.columns = ['Recomendaciones_Perdidas', 'Recomendaciones_Nuevas']
+
+    movement = base_summary.merge(other_summary, on=['mpio', 'dpto'], how='outer', suffixes=('_Base', '_Nueva'))
+    movement = movement.merge(changes.reset_index(), on=['mpio', 'dpto'], how='left')
+    movement[['Recomendaciones_Perdidas', 'Recomendaciones_Nuevas']] = (
+        movement[['Recomendaciones_Perdidas', 'Recomendaciones_Nuevas']].fillna(0).astype(int))
+    # Positivo = el municipio sube en el ranking
+    movement['Movimiento'] = movement['Posicion_Base'] - movement['Posicion_Nueva']
+    movement = movement.rename(columns={'mpio': 'Municipio', 'dpto': 'Departamento'})
+    return movement.sort_values(['Movimiento', 'Municipio'], ascending=[False, True], na_position='last')
+
+@st.cache_data(show_spinner="Cruzando oraciones entre versiones...", persist='disk')
+def compute_similarity_shift(base_signature, other_signature, policy_cutoff):
+    """Cruzar oraciones por (mpio, dpto, recommendation_code, sentence_id) entre dos versiones (guardado en disco)"""
+    # La unidad es (mpio, dpto): hay municipios con el mismo nombre en departamentos distintos
+    keys = ['mpio', 'dpto', 'recommendation_code', 'sentence_id']
+    columns = ['mpio', 'dpto', 'recommendation_code', 'sentence_id', 'sentence_similarity']
+    base = load_data(base_signature[0], policy_cutoff)[columns].drop_duplicates(keys)
+    other = load_data(other_signature[0], policy_cutoff)[columns].drop_duplicates(keys)
+    for frame in (base, other):
+        for col in ['mpio', 'dpto', 'recommendation_code']:
+            frame[col] = frame[col].astype(str)
+
+    joined = base.merge(other, on=keys, how='inner', suffixes=('_base', '_nueva'))
+    joined['Cambio_Similitud'] = (joined['sentence_similarity_nueva'].astype('float64') -
+                                  joined['sentence_similarity_base'].astype('float64'))
+    joined['Cambio_Absoluto'] = joined['Cambio_Similitud'].abs()
+
+    # Resumen por municipio: oraciones en cada versión, comunes y cambio de similitud de las comunes
+    unit_columns = ['mpio', 'dpto']
+    summary = pd.concat([
+        base.groupby(unit_columns).size().rename('Oraciones_Base'),
+        other.groupby(unit_columns).size().rename('Oraciones_Nueva'),
+        joined.groupby(unit_columns).agg(
+            Oraciones_Comunes=('Cambio_Similitud', 'size'),
+            Cambio_Promedio=('Cambio_Similitud', 'mean'),
+            Cambio_Absoluto_Promedio=('Cambio_Absoluto', 'mean'))
+    ], axis=1)
+    count_columns = ['Oraciones_Base', 'Oraciones_Nueva', 'Oraciones_Comunes']
+    summary[count_columns] = summary[count_columns].fillna(0).astype(int)
+    summary['Oraciones_Solo_Base'] = summary['Oraciones_Base'] - summary['Oraciones_Comunes']
+    summary['Oraciones_Solo_Nueva'] = summary['Oraciones_Nueva'] - summary['Oraciones_Comunes']
+    summary = summary.sort_index().rename_axis(unit_columns).reset_index()
+
+    # Matriz de transición (municipio, intervalo base, intervalo nuevo) sobre la grilla del umbral:
+    # permite contar las oraciones que cruzan cualquier umbral sin repetir el cruce
+    unit_codes = summary.set_index(['mpio', 'dpto']).index.get_indexer(
+        pd.MultiIndex.from_arrays([joined['mpio'], joined['dpto']]))
+    n_bins = len(SIMILARITY_GRID) + 1
+    bins = []
+    for suffix in ['base', 'nueva']:
+        similarity = joined[f'sentence_similarity_{suffix}'].to_numpy()
+        suffix_bins = np.searchsorted(SIMILARITY_GRID.astype(similarity.dtype), similarity, side='right')
+        suffix_bins[np.isnan(similarity)] = 0
+        bins.append(suffix_bins)
+    flat = (unit_codes * n_bins + bins[0]) * n_bins + bins[1]
+    transitions = np.bincount(flat, minlength=len(summary) * n_bins * n_bins).reshape(len(summary), n_bins, n_bins)
+
+    return summary, transitions.astype('int32')
+
+def similarity_shift_at_threshold(summary, transitions, sentence_threshold):
+    """Oraciones comunes que pasan a superar (o dejan de superar) el umbral en la versión nueva"""
+    # Intervalo k = número de puntos de la grilla <= similitud; supera el umbral si k > índice del umbral
+    cut = threshold_index(sentence_threshold) + 1
+    summary = summary.copy()
+    summary['Cruzan_Hacia_Arriba'] = transitions[:, :cut, cut:].sum(axis=(1, 2))
+    summary['Cruzan_Hacia_Abajo'] = transitions[:, cut:, :cut].sum(axis=(1, 2))
+    return summary.rename(columns={'mpio': 'Municipio', 'dpto': 'Departamento'})
+
+def filter_by_place(table, selected_department, selected_municipality):
+    """Aplicar los filtros de departamento y municipio a una tabla por municipio"""
+    if selected_department != 'Todos':
+        table = table[table['Departamento'] == selected_department]
+    if selected_municipality != 'Todos':
+        table = table[table['Municipio'] == selected_municipality]
+    return table
+
+def render_version_comparison(data_path, compare_path, include_policy_only, sentence_threshold,
+                              selected_department, selected_municipality, tie_method, tie_breakers):
+    """Comparación entre la versión de datos en uso y otra versión del dataset"""
+    st.markdown("---")
+    st.markdown("### 🔄 Comparación entre Versiones")
+    st.caption(f"Base: **{os.path.basename(data_path)}** · Comparada: **{os.path.basename(compare_path)}**")
+
+    movement = compute_ranking_movement(data_path, compare_path, POLICY_CONFIDENCE_CUTOFF,
+                                        include_policy_only, sentence_threshold, tie_method, tie_breakers)
+    shift_summary, transitions = compute_similarity_shift(
+        dataset_signature(data_path), dataset_signature(compare_path), POLICY_CONFIDENCE_CUTOFF)
+    # Los cruces de umbral se cuentan por municipio, sobre el umbral general
+    shift = similarity_shift_at_threshold(shift_summary, transitions, as_threshold_profile(sentence_threshold).default)
+
+    movement = filter_by_place(movement, selected_department, selected_municipality)
+    shift = filter_by_place(shift, selected_department, selected_municipality)
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Municipios que suben", int((movement['Movimiento'] > 0).sum()))
+    with col2:
+        st.metric("Municipios que bajan", int((movement['Movimiento'] < 0).sum()))
+    with col3:
+        st.metric("Recomendaciones nuevas", int(movement['Recomendaciones_Nuevas'].sum()),
+                  delta=-int(movement['Recomendaciones_Perdidas'].sum()) or None,
+                  help="Pares municipio-recomendación que solo se implementan en la versión comparada; "
+                       "el delta indica los que se pierden")
+    with col4:
+        common = shift['Oraciones_Comunes'].sum()
+        mean_shift = (shift['Cambio_Promedio'] * shift['Oraciones_Comunes']).sum() / common if common else 0
+        st.metric("Cambio de similitud promedio", f"{mean_shift:+.3f}",
+                  help="Promedio sobre las oraciones presentes en ambas versiones (sin filtro de política)")
+
+    tab_ranking, tab_similarity = st.tabs(["📊 Movimiento en el ranking", "📈 Cambios de similitud"])
+    with tab_ranking:
+        st.dataframe(movement, hide_index=True, width='stretch')
+        st.download_button("📄 Descargar", data=to_csv_utf8_bom(movement),
+                           file_name="comparacion_ranking.csv", mime="text/csv; charset=utf-8")
+    with tab_similarity:
+        st.dataframe(shift, hide_index=True, width='stretch')
+        st.download_button("📄 Descargar", data=to_csv_utf8_bom(shift),
+                           file_name="comparacion_similitud.csv", mime="text/csv; charset=utf-8")
+
+@st.cache_resource(show_spinner="Cargando límites municipales...")
+def load_municipal_geometries(geometry_path=GEOMETRY_PATH, department='Todos'):
+    """GeoJSON pre-simplificado de los municipios (solo los del departamento si se indica)"""
+    if department != 'Todos':
+        geojson = load_municipal_geometries(geometry_path, 'Todos')
+        prefix = f"{normalize_place_name(department)}|"
+        return {'type': 'FeatureCollection',
+                'features': [feature for feature in geojson['features'] if feature['id'].startswith(prefix)]}
+
+    with open(geometry_path, encoding='utf-8') as f:
+        return json.load(f)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def compute_map_values(data_path, policy_cutoff, include_policy_only, sentence_threshold):
+    """Recomendaciones implementadas por unidad (mpio, dpto) para colorear el mapa"""
+    histograms = load_similarity_histograms(data_path, policy_cutoff)
+    kpis = load_implementation_kpis(data_path, policy_cutoff)
+    return kpis.counts(histograms, include_policy_only, sentence_threshold)[0]
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def publish_geometries(geometry_path, department):
+    """URL del GeoJSON del departamento, escrito una vez en static/: el navegador lo descarga aparte del gráfico"""
+    geojson = load_municipal_geometries(geometry_path, department)
+    payload = json.dumps(geojson, separators=(',', ':')).encode('utf-8')
+    # El nombre depende del contenido: un archivo de geometrías nuevo no reutiliza la copia del navegador
+    file_name = f"{hashlib.sha1(payload).hexdigest()[:16]}.json"
+    path = os.path.join(STATIC_MAPS_DIR, file_name)
+    if not os.path.exists(path):
+        os.makedirs(STATIC_MAPS_DIR, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(temp_path, path)
+    return f"app/static/mapas/{file_name}"
+
+@st.cache_resource(show_spinner="Preparando el mapa...", max_entries=64)
+def load_map_units(geometry_path, data_path, policy_cutoff, department):
+    """Unidades del departamento con polígono en el mapa: llaves, etiquetas y máscara sobre las unidades"""
+    geojson = load_municipal_geometries(geometry_path, department)
+
+    units = load_similarity_histograms(data_path, policy_cutoff).units
+    in_department = np.ones(len(units), dtype=bool)
+    if department != 'Todos':
+        in_department = (units['dpto'] == department).to_numpy()
+
+    available_keys = {feature['id'] for feature in geojson['features']}
+    mask = in_department & units['place_key'].isin(available_keys).to_numpy()
+    locations = units.loc[mask, 'place_key'].astype(str).tolist()
+    customdata = units.loc[mask, ['mpio', 'dpto']].astype(str).to_numpy()
+    return locations, customdata, mask, int(in_department.sum() - mask.sum())
+
+def build_map_figure(data_path, map_values, selected_department):
+    """(figura del mapa, municipios sin polígono), o None si falta el archivo de geometrías"""
+    import plotly.graph_objects as go
+
+    if not os.path.exists(GEOMETRY_PATH):
+        return None
+
+    locations, customdata, mask, missing = load_map_units(
+        GEOMETRY_PATH, data_path, POLICY_CONFIDENCE_CUTOFF, selected_department)
+    # Con archivos estáticos la figura solo lleva la URL de las geometrías, no los polígonos
+    if st.get_option('server.enableStaticServing'):
+        geojson = publish_geometries(GEOMETRY_PATH, selected_department)
+    else:
+        geojson = load_municipal_geometries(GEOMETRY_PATH, selected_department)
+
+    fig_map = go.Figure(go.Choropleth(
+        geojson=geojson,
+        featureidkey='id',
+        locations=locations,
+        z=map_values[mask],
+        customdata=customdata,
+        hovertemplate='<b>%{customdata[0]}</b>, %{customdata[1]}<br>Recomendaciones implementadas: %{z}<extra></extra>',
+        colorscale='Blues',
+        marker_line_width=0.3,
+        marker_line_color='white',
+        colorbar_title='Recomendaciones'
+    ))
+    # Proyección sin mapa base: no se descargan teselas, solo los polígonos del archivo local
+    fig_map.update_geos(fitbounds='locations', visible=False)
+    fig_map.update_layout(height=600, margin=dict(l=0, r=0, t=0, b=0))
+    return fig_map, missing
+
+def render_municipality_map(map_figure):
+    """Mapa coroplético de recomendaciones implementadas por municipio"""
+    if map_figure is None:
+        st.info(f"Mapa no disponible: falta el archivo '{GEOMETRY_PATH}'. "
+                "Genérelo con `python App/simplificar_geometrias.py <municipios.geojson>`.")
+        return
+
+    fig_map, missing = map_figure
+    st.plotly_chart(fig_map, width='stretch')
+    if missing > 0:
+        st.caption(f"{missing} municipios sin límite geográfico en el archivo de geometrías.")
+
+def create_frequency_data(recommendations, rec_counts, top_n=5):
+    """Top de recomendaciones por número de oraciones sobre el umbral"""
+    freq_analysis = pd.DataFrame({
+        'Código': recommendations['recommendation_code'].astype(str),
+        'Frecuencia': rec_counts,
+        'Texto': recommendations['recommendation_text'].astype(str)
+    })
+    freq_analysis = freq_analysis[freq_analysis['Frecuencia'] > 0]
+    return freq_analysis.sort_values('Frecuencia', ascending=False, kind='stable').head(top_n)
+
+def create_topic_data(recommendations, rec_counts):
+    """Recomendaciones con al menos una oración sobre el umbral, por tema"""
+    implemented = recommendations.loc[rec_counts > 0, 'recommendation_topic'].dropna()
+    topic_analysis = implemented.astype(str).value_counts().rename_axis('Tema').reset_index(name='Recomendaciones_Implementadas')
+    return topic_analysis.sort_values('Recomendaciones_Implementadas', ascending=False, kind='stable')
+
+def create_distribution_data(distribution, sentence_threshold):
+    """Distribución de la similitud de las oraciones en intervalos de la grilla"""
+    # El intervalo que empieza en 1.0 solo contiene similitudes exactamente iguales a 1 y se suma al anterior
+    counts = distribution[:-1].copy()
+    counts[-1] += distribution[-1]
+    starts = SIMILARITY_GRID[:-1]
+    return pd.DataFrame({
+        'Intervalo': [f"{start:.2f}-{start + SIMILARITY_STEP:.2f}" for start in starts],
+        'Oraciones': counts,
+        'Sobre_Umbral': np.where(starts >= sentence_threshold, 'Sobre el umbral', 'Bajo el umbral')
+    })
+
 def create_variable_dictionary():
     """Crear diccionario de variables del dataset"""
     dictionary = {
@@ -122,45 +882,117 @@ def create_variable_dictionary():
     }
     return pd.DataFrame(dictionary)
 
-def create_ranking_data(df, sentence_threshold, include_policy_only):
-    """Crear datos de ranking de municipios"""
-    ranking_data = df.copy()
-
-    # Aplicar filtro de política si está activado
-    if include_policy_only:
-        ranking_data = ranking_data[
-            (ranking_data['predicted_class'] == 'Incluida') |
-            ((ranking_data['predicted_class'] == 'Excluida') & (ranking_data['prediction_confidence'] < 0.8))
-            ]
-
-    # Calcular ranking
-    ranking_data = ranking_data.groupby(['mpio', 'dpto']).agg({
-        'recommendation_code': lambda x: len(set(x[df.loc[x.index, 'sentence_similarity'] >= sentence_threshold])),
-        'sentence_similarity': ['count', 'mean'],
-        'IPM_2018': 'first',
-        'PDET': 'first',
-        'Cat_IICA': 'first',
-        'Grupo_MDM': 'first'
-    }).reset_index()
-
-    # Aplanar columnas
+@dataclass
+class RankingState:
+    """Ranking de municipios para un estado de filtros, con búsqueda de posición en tiempo constante"""
+    table: pd.DataFrame  # una fila por (mpio, dpto), ordenada por posición
+    by_unit: dict        # (mpio, dpto) -> fila de la tabla
+    by_name: dict        # mpio -> fila de la tabla (la mejor posición si el nombre se repite)
+
+    def _row(self, municipality, department='Todos'):
+        if department != 'Todos':
+            return self.by_unit.get((municipality, department))
+        return self.by_name.get(municipality)
+
+    def position(self, municipality, department='Todos'):
+        """Posición del municipio en el ranking, o None si no aparece"""
+        row = self._row(municipality, department)
+        return None if row is None else int(self.table['Ranking'].iat[row])
+
+    def peer_percentiles(self, municipality, department='Todos'):
+        """Percentiles del municipio dentro de su Grupo MDM y de su grupo PDET"""
+        row = self._row(municipality, department)
+        if row is None:
+            return {}
+        return {column: self.table[column].iat[row] for column in PEER_PERCENTILE_COLUMNS}
+
+def tie_group_starts(sorted_keys):
+    """True en la primera fila de cada grupo de empate (tabla ya ordenada, NaN cuenta como igual)"""
+    filled = sorted_keys.astype(object).where(sorted_keys.notna(), '__nan__')
+    changed = (filled != filled.shift()).any(axis=1).to_numpy()
+    return changed | (np.arange(len(changed)) == 0)
+
+# Compartido como recurso (solo lectura): cache_data tendría que serializar RankingState, cuya clase
+# se redefine en cada rerun del script y deja de coincidir cuando hay varias sesiones
+@st.cache_resource(show_spinner=False, max_entries=128)
+def compute_ranking(data_path, policy_cutoff, include_policy_only, sentence_threshold,
+                    tie_method=DEFAULT_TIE_METHOD, tie_breakers=()):
+    """Ranking de municipios en una sola pasada vectorizada sobre los histogramas precalculados"""
+    histograms = load_similarity_histograms(data_path, policy_cutoff)
+    stats = histograms.unit_stats[include_policy_only]
+
+    implemented, priority_implemented = load_implementation_kpis(data_path, policy_cutoff).counts(
+        histograms, include_policy_only, sentence_threshold)
+
+    ranking_data = histograms.units[['mpio', 'dpto']].copy()
+    ranking_data['Recomendaciones_Implementadas'] = implemented
+    ranking_data['Prioritarias_Implementadas'] = priority_implemented
+    ranking_data['Total_Oraciones'] = stats['sentences']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ranking_data['Similitud_Promedio'] = stats['similarity_sum'] / stats['sentences']
+    ranking_data = pd.concat([ranking_data, histograms.units[['IPM_2018', 'PDET', 'Cat_IICA', 'Grupo_MDM']]], axis=1)
     ranking_data.columns = ['Municipio', 'Departamento', 'Recomendaciones_Implementadas',
-                            'Total_Oraciones', 'Similitud_Promedio', 'IPM_2018', 'PDET',
-                            'Cat_IICA', 'Grupo_MDM']
-
-    # Ordenar por recomendaciones implementadas
-    ranking_data = ranking_data.sort_values('Recomendaciones_Implementadas', ascending=False)
-    ranking_data['Ranking'] = range(1, len(ranking_data) + 1)
-
-    # Reordenar columnas
-    ranking_data = ranking_data[['Ranking', 'Municipio', 'Departamento', 'Recomendaciones_Implementadas',
-                                 'Total_Oraciones', 'Similitud_Promedio', 'IPM_2018', 'PDET',
-                                 'Cat_IICA', 'Grupo_MDM']]
-
+                            'Prioritarias_Implementadas', 'Total_Oraciones', 'Similitud_Promedio',
+                            'IPM_2018', 'PDET', 'Cat_IICA', 'Grupo_MDM']
+
+    # Solo municipios con filas bajo el filtro de política actual
+    ranking_data = ranking_data[stats['rows'] > 0]
+
+    # Orden determinístico: criterio principal, desempates elegidos y, al final, el nombre
+    key_columns = ['Recomendaciones_Implementadas'] + [TIE_BREAKERS[name][0] for name in tie_breakers]
+    ascending = [False] + [TIE_BREAKERS[name][1] for name in tie_breakers]
+    ranking_data = ranking_data.sort_values(key_columns + ['Municipio', 'Departamento'],
+                                            ascending=ascending + [True, True],
+                                            kind='stable', na_position='last').reset_index(drop=True)
+
+    # Posiciones con empates: 'min' (1, 2, 2, 4) o 'dense' (1, 2, 2, 3)
+    starts = tie_group_starts(ranking_data[key_columns])
+    if tie_method == 'dense':
+        positions = np.cumsum(starts)
+    else:
+        positions = np.maximum.accumulate(np.where(starts, np.arange(1, len(starts) + 1), 0))
+    ranking_data.insert(0, 'Ranking', positions)
+
+    # Percentil dentro de grupos pares: % del grupo con posición igual o peor
+    for column, group in zip(PEER_PERCENTILE_COLUMNS, ['Grupo_MDM', 'PDET']):
+        ranking_data[column] = (ranking_data.groupby(group, observed=True, dropna=False)['Ranking']
+                                .rank(method='max', ascending=False, pct=True) * 100).round(1)
+
+    by_unit = {key: row for row, key in enumerate(zip(ranking_data['Municipio'], ranking_data['Departamento']))}
+    by_name = {}
+    for row, name in enumerate(ranking_data['Municipio']):
+        by_name.setdefault(name, row)
+    return RankingState(table=ranking_data, by_unit=by_unit, by_name=by_name)
+
+def create_ranking_data(data_path, include_policy_only, sentence_threshold,
+                        tie_method=DEFAULT_TIE_METHOD, tie_breakers=()):
+    """Crear datos de ranking de municipios"""
+    ranking = compute_ranking(data_path, POLICY_CONFIDENCE_CUTOFF, include_policy_only, sentence_threshold,
+                              tie_method, tuple(tie_breakers))
+    ranking_data = ranking.table.copy()
+    for column in ['Municipio', 'Departamento', 'Cat_IICA', 'Grupo_MDM']:
+        ranking_data[column] = ranking_data[column].astype(str).where(ranking_data[column].notna())
     return ranking_data
 
+@st.cache_data(show_spinner=False)
+def load_export_columns(data_path, policy_cutoff):
+    """Columnas exportables del dataset: del metadata.json de los artefactos si están al día, si no de los datos"""
+    metadata = load_artifact_metadata(data_path, policy_cutoff)
+    if metadata is not None and 'columnas' in metadata:
+        return [col for col in metadata['columnas'] if col not in DERIVED_COLUMNS]
+    df = load_data(data_path, policy_cutoff)
+    return [] if df is None else select_export_columns(df).columns.tolist()
+
+def select_export_columns(df, columns=None):
+    """Columnas del dataset a exportar (sin columnas derivadas), en el orden original"""
+    available = [col for col in df.columns if col not in DERIVED_COLUMNS]
+    if columns is not None:
+        available = [col for col in available if col in set(columns)]
+    return df[available]
+
 def create_excel_file(filtered_data, ranking_data, dictionary_df):
     """Crear archivo Excel con ranking, datos filtrados y diccionario"""
+    from openpyxl.styles import Font, PatternFill, Alignment
     output = io.BytesIO()
 
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -168,6 +1000,7 @@ def create_excel_file(filtered_data, ranking_data, dictionary_df):
         ranking_data.to_excel(writer, sheet_name='Ranking_Municipios', index=False)
 
         # Pestaña 2: Datos filtrados
+        filtered_data = select_export_columns(filtered_data)
         filtered_data.to_excel(writer, sheet_name='Datos_Filtrados', index=False)
 
         # Pestaña 3: Diccionario
@@ -200,54 +1033,758 @@ def create_excel_file(filtered_data, ranking_data, dictionary_df):
     output.seek(0)
     return output
 
+def write_csv_utf8_bom(df, binary_stream, chunk_rows=CSV_CHUNK_ROWS):
+    """Escribir el DataFrame como CSV UTF-8 con BOM, por bloques, en un flujo binario"""
+    # utf-8-sig agrega el BOM (Byte Order Mark) una sola vez al inicio
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='', write_through=True)
+    for start in range(0, max(len(df), 1), chunk_rows):
+        df.iloc[start:start + chunk_rows].to_csv(text_stream, index=False, header=(start == 0))
+    text_stream.flush()
+    # Soltar el flujo binario sin cerrarlo: quien lo creó decide cuándo cerrarlo
+    text_stream.detach()
+
 def to_csv_utf8_bom(df):
     """Convertir DataFrame a CSV con codificación UTF-8 BOM"""
-    # Crear CSV como string
-    csv_string = df.to_csv(index=False, encoding='utf-8')
-    # Agregar BOM (Byte Order Mark) para UTF-8
-    csv_bytes = '\ufeff' + csv_string
-    return csv_bytes.encode('utf-8')
+    output = io.BytesIO()
+    write_csv_utf8_bom(df, output)
+    return output.getvalue()
 
-def main():
-    """Main function to run the Streamlit app"""
+def parquet_available():
+    """Parquet requiere pyarrow o fastparquet, que son opcionales"""
+    return any(importlib.util.find_spec(engine) is not None for engine in ['pyarrow', 'fastparquet'])
 
-    # Load data
-    df = load_data()
-    if df is None:
-        st.stop()
+def available_export_formats():
+    """Formatos de descarga que se pueden generar en este entorno"""
+    return [name for name, (extension, _) in EXPORT_FORMATS.items()
+            if extension != 'parquet' or parquet_available()]
 
-    # Sidebar for filters
-    st.sidebar.markdown("### 🔧 Configuración de Filtros")
+def create_export_file(filtered_data, ranking_data, dictionary_df, export_format, columns=None):
+    """Generar el archivo de descarga en el formato elegido; devuelve (bytes, extensión, mime)"""
+    extension, mime = EXPORT_FORMATS[export_format]
+    filtered_data = select_export_columns(filtered_data, columns)
 
-    # Department filter
-    departments = sorted(df['dpto'].unique())
-    selected_department = st.sidebar.selectbox(
-        "Departamento:",
-        options=['Todos'] + departments,
-        index=0
+    if extension == 'xlsx':
+        if len(filtered_data) > EXCEL_MAX_ROWS:
+            raise ValueError(f"Excel admite máximo {EXCEL_MAX_ROWS:,} filas por hoja; use CSV o Parquet")
+        return create_excel_file(filtered_data, ranking_data, dictionary_df).getvalue(), extension, mime
+
+    output = io.BytesIO()
+    if extension == 'csv':
+        write_csv_utf8_bom(filtered_data, output)
+    elif extension == 'csv.gz':
+        with gzip.GzipFile(fileobj=output, mode='wb', mtime=0) as compressed:
+            write_csv_utf8_bom(filtered_data, compressed)
+    elif extension == 'zip':
+        # Mismo contenido que las pestañas del Excel, un CSV por tabla
+        with zipfile.ZipFile(output, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, table in [('Ranking_Municipios', ranking_data), ('Datos_Filtrados', filtered_data),
+                                ('Diccionario_Variables', dictionary_df)]:
+                with archive.open(f"{name}.csv", mode='w', force_zip64=True) as entry:
+                    write_csv_utf8_bom(table, entry)
+    elif extension == 'parquet':
+        filtered_data.to_parquet(output, index=False)
+
+    return output.getvalue(), extension, mime
+
+def current_session_id():
+    """Identificador de la sesión de Streamlit ('local' fuera de un servidor)"""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else 'local'
+
+class ExportStore:
+    """Descargas preparadas por sesión, compartidas por el proceso (fuera de st.session_state)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # session_id -> (datos, metadatos, último acceso); la menos usada primero
+
+    def put(self, session_id, data, metadata, session_budget_bytes, store_budget_bytes):
+        """Guardar la descarga de una sesión; devuelve las sesiones desalojadas para hacer espacio"""
+        if len(data) > session_budget_bytes:
+            raise ValueError(f"El archivo ({len(data) / 1024 ** 2:.0f} MB) supera el máximo por sesión "
+                             f"({session_budget_bytes / 1024 ** 2:.0f} MB); quite columnas o use un formato comprimido")
+        with self._lock:
+            self._entries.pop(session_id, None)
+            evicted = []
+            while self._entries and self._total_bytes() + len(data) > store_budget_bytes:
+                evicted.append(self._entries.popitem(last=False)[0])
+            self._entries[session_id] = (data, metadata, time.monotonic())
+        return evicted
+
+    def get(self, session_id):
+        """Descarga de la sesión y sus metadatos, o None; cuenta como acceso reciente"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            self._entries[session_id] = (entry[0], entry[1], time.monotonic())
+            self._entries.move_to_end(session_id)
+            return entry[0], entry[1]
+
+    def discard(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def release_idle(self, max_idle_seconds):
+        """Liberar las descargas de sesiones inactivas; devuelve las sesiones liberadas"""
+        cutoff = time.monotonic() - max_idle_seconds
+        with self._lock:
+            idle = [session_id for session_id, (_, _, last_access) in self._entries.items() if last_access < cutoff]
+            for session_id in idle:
+                del self._entries[session_id]
+        return idle
+
+    def nbytes(self, session_id=None):
+        """Bytes guardados por una sesión, o por todas"""
+        with self._lock:
+            if session_id is None:
+                return self._total_bytes()
+            entry = self._entries.get(session_id)
+            return len(entry[0]) if entry is not None else 0
+
+    def _total_bytes(self):
+        return sum(len(data) for data, _, _ in self._entries.values())
+
+@st.cache_resource
+def get_export_store():
+    """Almacén de descargas único por proceso"""
+    return ExportStore()
+
+def deferred_export(store, session_id):
+    """Lectura diferida de la descarga de la sesión: Streamlit la pide al hacer clic, sin guardar otra copia"""
+    def read():
+        prepared = store.get(session_id)
+        if prepared is None:
+            raise RuntimeError("La descarga fue liberada por inactividad o falta de memoria; prepárela de nuevo")
+        return prepared[0]
+    return read
+
+def manage_session_memory(store, session_id, state=None):
+    """Liberar descargas inactivas de cualquier sesión y actualizar los contadores de esta sesión"""
+    released = store.release_idle(SESSION_IDLE_SECONDS)
+    if released:
+        logger.info(f"Descargas liberadas por inactividad (> {SESSION_IDLE_SECONDS} s): {len(released)} sesiones")
+
+    # La descarga de esta sesión desapareció sin que el usuario la descartara: se liberó por otra sesión
+    usage = session_usage(state)
+    export_bytes = store.nbytes(session_id)
+    if usage.get('descarga_mb', 0) > 0 and export_bytes == 0:
+        record_eviction('descarga', state=state)
+        st.sidebar.info("La descarga preparada se liberó para ahorrar memoria; prepárela de nuevo.")
+    usage['descarga_mb'] = export_bytes / 1024 ** 2
+    return usage
+
+def compute_implementation_charts(histograms, muni_units, include_policy_only, sentence_threshold):
+    """Tablas de los gráficos de la ficha (top, temas, distribución); None si la sección no se muestra"""
+    # Conteos por recomendación tomados de los histogramas precalculados (sin agrupar filas)
+    rec_counts = histograms.counts_at(muni_units, include_policy_only, sentence_threshold)
+    freq_analysis = topic_analysis = distribution_analysis = None
+    if rec_counts.any():
+        freq_analysis = create_frequency_data(histograms.recommendations, rec_counts)
+        if 'recommendation_topic' in histograms.recommendations.columns:
+            topic_analysis = create_topic_data(histograms.recommendations, rec_counts)
+
+    distribution = histograms.distribution(muni_units, include_policy_only)
+    if distribution.any():
+        distribution_analysis = create_distribution_data(distribution, as_threshold_profile(sentence_threshold).default)
+    return freq_analysis, topic_analysis, distribution_analysis
+
+@st.fragment
+def render_implementation_charts(histograms, muni_units, include_policy_only, sentence_threshold):
+    """Gráficos de implementación de la ficha (se re-ejecutan solos al interactuar con ellos)"""
+    import plotly.express as px
+    # Top 5 Recommendations by Frequency Chart
+    st.markdown(" ")
+    st.markdown(" ")
+
+    freq_analysis, topic_analysis, distribution_analysis = compute_implementation_charts(
+        histograms, muni_units, include_policy_only, sentence_threshold)
+
+    if freq_analysis is not None:
+        # Header con botón de descarga
+        col_header, col_download = st.columns([4, 1])
+        with col_header:
+            st.markdown("### Top 5 Recomendaciones más Frecuentes")
+        with col_download:
+            # Botón minimalista de descarga
+            st.markdown("""
+            <style>
+            .download-btn {
+                background: none;
+                border: 1px solid #e0e0e0;
+                border-radius: 6px;
+                padding: 4px 8px;
+                font-size: 12px;
+                color: #666;
+                cursor: pointer;
+                transition: all 0.2s;
+            }
+            .download-btn:hover {
+                background: #f8f9fa;
+                border-color: #007bff;
+                color: #007bff;
+            }
+            </style>
+            """, unsafe_allow_html=True)
+
+        if not freq_analysis.empty:
+            with col_download:
+                csv_freq = to_csv_utf8_bom(freq_analysis)
+                st.download_button(
+                    label="📄 Descargar",
+                    data=csv_freq,
+                    file_name="top_5_recomendaciones_frecuentes.csv",
+                    mime="text/csv; charset=utf-8",
+                    help="Descargar datos del gráfico",
+                    width='stretch'
+                )
+
+            # Gráfico
+            fig_freq = px.bar(
+                freq_analysis,
+                x='Frecuencia',
+                y='Código',
+                orientation='h',
+                title='Número de Oraciones por Recomendación',
+                labels={'Frecuencia': 'Número de Oraciones', 'Código': 'Código de Recomendación'},
+                color='Frecuencia',
+                color_continuous_scale='blues',
+                hover_data={'Texto': True, 'Frecuencia': True}
+            )
+            fig_freq.update_layout(
+                height=400,
+                showlegend=False,
+                coloraxis_showscale=False
+            )
+            st.plotly_chart(fig_freq, width='stretch')
+
+    # Implementation Heatmap by Topic
+    if topic_analysis is not None:
+        # Header con botón de descarga
+        col_header2, col_download2 = st.columns([4, 1])
+        with col_header2:
+            st.markdown("#### Implementación por Tema")
+
+        if not topic_analysis.empty:
+            with col_download2:
+                csv_topics = to_csv_utf8_bom(topic_analysis)
+                st.download_button(
+                    label="📄 Descargar",
+                    data=csv_topics,
+                    file_name="implementacion_por_tema.csv",
+                    mime="text/csv; charset=utf-8",
+                    help="Descargar datos del gráfico",
+                    width='stretch'
+                )
+
+            # Gráfico
+            fig_heatmap = px.bar(
+                topic_analysis,
+                x='Recomendaciones_Implementadas',
+                y='Tema',
+                orientation='h',
+                title='Recomendaciones Implementadas por Tema',
+                labels={'Recomendaciones_Implementadas': 'Número de Recomendaciones', 'Tema': ''},
+                color='Recomendaciones_Implementadas',
+                color_continuous_scale='viridis'
+            )
+            fig_heatmap.update_layout(
+                height=400,
+                showlegend=False,
+                yaxis={'categoryorder': 'total ascending'},
+                margin=dict(l=150, r=50, t=80, b=50),
+                coloraxis_showscale=False
+            )
+            st.plotly_chart(fig_heatmap, width='stretch')
+
+    # Similarity distribution chart
+    if distribution_analysis is not None:
+        col_header3, col_download3 = st.columns([4, 1])
+        with col_header3:
+            st.markdown("#### Distribución de Similitud de las Oraciones")
+
+        with col_download3:
+            csv_distribution = to_csv_utf8_bom(distribution_analysis)
+            st.download_button(
+                label="📄 Descargar",
+                data=csv_distribution,
+                file_name="distribucion_similitud.csv",
+                mime="text/csv; charset=utf-8",
+                help="Descargar datos del gráfico",
+                width='stretch'
+            )
+
+        # Gráfico
+        fig_distribution = px.bar(
+            distribution_analysis,
+            x='Intervalo',
+            y='Oraciones',
+            title='Oraciones por Intervalo de Similitud',
+            labels={'Intervalo': 'Similitud', 'Oraciones': 'Número de Oraciones', 'Sobre_Umbral': ''},
+            color='Sobre_Umbral',
+            color_discrete_map={'Sobre el umbral': '#1f77b4', 'Bajo el umbral': '#c7c7c7'}
+        )
+        fig_distribution.update_layout(
+            height=350,
+            bargap=0.05,
+            legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='right', x=1)
+        )
+        st.plotly_chart(fig_distribution, width='stretch')
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def compute_recommendation_matches(_high_quality_sentences, state_key, sentence_threshold, rec_code, level):
+    """Coincidencias de una recomendación por párrafo u oración (cacheado por estado de filtros)"""
+    rec_data = _high_quality_sentences[_high_quality_sentences['recommendation_code'] == rec_code]
+
+    if level == 'oraciones':
+        return rec_data.sort_values('sentence_similarity', ascending=False)
+
+    # Group by paragraph and calculate paragraph-level similarity
+    paragraph_analysis = rec_data.groupby(['paragraph_id', 'paragraph_text'], observed=True).agg({
+        'paragraph_similarity': 'first',
+        'page_number': 'first',
+        'sentence_similarity': ['count', 'mean', 'max'],
+        'predicted_class': lambda x: x.mode()[0] if not x.empty else 'N/A'
+    }).reset_index()
+
+    paragraph_analysis.columns = ['ID_Párrafo', 'Texto_Párrafo', 'Similitud_Párrafo', 'Página',
+                                  'Num_Oraciones', 'Similitud_Prom', 'Similitud_Max',
+                                  'Clasificación_ML']
+    return paragraph_analysis.sort_values('Similitud_Prom', ascending=False)
+
+def paginate(items, pagina_key, coincidencias_por_pagina=5, state=None):
+    """Página actual de una tabla de coincidencias según el estado de la sesión"""
+    state = st.session_state if state is None else state
+    total_coincidencias = len(items)
+    total_paginas = max(1, (total_coincidencias - 1) // coincidencias_por_pagina + 1)
+
+    # Initialize current page, and validate it doesn't exceed total
+    if state.get(pagina_key, 1) > total_paginas or pagina_key not in state:
+        state[pagina_key] = 1
+    touch_pagination_key(pagina_key, state)
+
+    pagina_actual = state[pagina_key]
+    inicio = (pagina_actual - 1) * coincidencias_por_pagina
+    return items.iloc[inicio:inicio + coincidencias_por_pagina], pagina_actual, total_paginas
+
+def recommendation_matches_page(high_quality_sentences, state_key, sentence_threshold, rec_code, level,
+                                state=None):
+    """(coincidencias de la recomendación, clave de página, filas de la página, página actual, total de páginas)"""
+    matches = compute_recommendation_matches(high_quality_sentences, state_key, sentence_threshold, rec_code, level)
+    pagina_key = f'{PAGINATION_KEY_PREFIX}{rec_code}_{level}'
+    return (matches, pagina_key) + paginate(matches, pagina_key, state=state)
+
+@st.fragment
+def render_detailed_analysis(high_quality_sentences, recommendations, state_key, sentence_threshold):
+    """Análisis detallado por recomendación; la paginación solo re-ejecuta esta sección"""
+    if not high_quality_sentences.empty:
+        # Recommendation selector (keep original dropdown functionality)
+        available_recommendations = high_quality_sentences['recommendation_code'].unique().tolist()
+        rec_texts = dict(zip(recommendations['recommendation_code'].astype(str),
+                             recommendations['recommendation_text'].astype(str)))
+
+        selected_rec_code = st.selectbox(
+            "Seleccione una recomendación:",
+            options=available_recommendations,
+            format_func=lambda x: f"{x} - {rec_texts[x][:60]}...",
+            key="detailed_rec_select",
+            label_visibility="collapsed"  # <- This hides the label but keeps it for accessibility
+        )
+
+        if selected_rec_code:
+            # Show recommendation text
+            st.markdown("**Texto de la Recomendación:**")
+            st.info(rec_texts[selected_rec_code])
+
+            # Hierarchical navigation tabs
+            tab = st.segmented_control(
+                "Nivel de análisis:",
+                ["📝 Párrafos", "💬 Oraciones"],
+                selection_mode="single",
+                default="💬 Oraciones",
+                key="hierarchy_tabs"
+            )
+
+            # TAB 1: PARAGRAPH LEVEL
+            if tab == "📝 Párrafos":
+                st.markdown("**Análisis por Párrafos:**")
+
+                # PAGINATION FOR PARAGRAPHS
+                (paragraph_analysis, pagina_key, paragraph_analysis_paginado, pagina_actual,
+                 total_paginas) = recommendation_matches_page(high_quality_sentences, state_key, sentence_threshold,
+                                                              selected_rec_code, 'parrafos')
+
+                # Show pagination info
+                st.write(
+                    f"📋 Mostrando {len(paragraph_analysis_paginado)} de {len(paragraph_analysis)} párrafos (Página {pagina_actual} de {total_paginas})")
+
+                # Show paginated paragraphs
+                for idx, row in paragraph_analysis_paginado.iterrows():
+                    with st.expander(
+                            f"Párrafo {row['ID_Párrafo']} - Similitud Promedio: {row['Similitud_Prom']:.3f}",
+                            expanded=idx == paragraph_analysis_paginado.index[0]):  # Only first expanded
+                        col1, col2 = st.columns([3, 1])
+
+                        with col1:
+                            st.write("**Contenido del Párrafo:**")
+                            # Truncate very long text
+                            para_text = row['Texto_Párrafo'][:800] + "..." if len(
+                                row['Texto_Párrafo']) > 800 else row['Texto_Párrafo']
+                            st.write(para_text)
+
+                        with col2:
+                            st.write("**Métricas:**")
+                            st.write(f"**ID Página:** {row['Página']}")
+                            st.write(f"**ID Párrafo:** {row['ID_Párrafo']}")
+                            st.write(f"**Similitud Párrafo:** {row['Similitud_Párrafo']:.3f}")
+
+                # Show pagination controls for paragraphs
+                mostrar_paginacion_coincidencias(pagina_key, total_paginas, f"parrafos_{selected_rec_code}")
+
+            # TAB 2: SENTENCE LEVEL
+            else:  # "💬 Oraciones"
+                st.markdown("**Análisis por Oraciones:**")
+
+                # PAGINATION FOR SENTENCES
+                (sentence_analysis, pagina_key, sentence_analysis_paginado, pagina_actual,
+                 total_paginas) = recommendation_matches_page(high_quality_sentences, state_key, sentence_threshold,
+                                                              selected_rec_code, 'oraciones')
+
+                # Show pagination info
+                st.write(
+                    f"📋 Mostrando {len(sentence_analysis_paginado)} de {len(sentence_analysis)} oraciones (Página {pagina_actual} de {total_paginas})")
+
+                # Show paginated sentences
+                for idx, (_, row) in enumerate(sentence_analysis_paginado.iterrows()):
+                    sentence_id = row.get('sentence_id_paragraph', f'S{idx + 1}')
+
+                    with st.expander(f"Oración {sentence_id} - Similitud: {row['sentence_similarity']:.3f}",
+                                     expanded=idx == 0):  # Only first expanded
+                        col1, col2 = st.columns([3, 1])
+
+                        with col1:
+                            st.write("**Contenido:**")
+                            st.write(row['sentence_text'])
+
+                        with col2:
+                            st.write("**Métricas:**")
+                            if 'sentence_id' in row and pd.notna(row['sentence_id']):
+                                st.write(f"**ID Oración:** {row['sentence_id']}")
+                            st.write(f"**ID Página:** {row['page_number']}")
+                            st.write(f"**ID Párrafo:** {row.get('paragraph_id', 'N/A')}")
+                            st.write(f"**Similitud Oración:** {row['sentence_similarity']:.3f}")
+                            st.write(f"**Clasificación ML:** {row['predicted_class']}")
+
+                # Show pagination controls for sentences
+                mostrar_paginacion_coincidencias(pagina_key, total_paginas, f"oraciones_{selected_rec_code}")
+
+    else:
+        st.info("No hay recomendaciones disponibles con el filtro actual.")
+
+@st.fragment
+def render_paragraph_browser(df, paragraph_index, recommendations, unit, include_policy_only, sentence_threshold):
+    """Navegación por página y párrafo del plan, con las recomendaciones que cruza cada párrafo"""
+    pages = paragraph_index.unit_pages(unit)
+    if len(pages) == 0:
+        st.info("No hay párrafos con similitud calculada para este municipio.")
+        return
+
+    page = st.selectbox("Página del plan:", options=pages.tolist(), key="paragraph_browser_page")
+    threshold_indices = as_threshold_profile(sentence_threshold).indices(recommendations)
+
+    # Solo los párrafos con al menos una recomendación sobre el umbral
+    paragraphs = paragraph_index.page_paragraphs(unit, page)
+    matched = []
+    for paragraph in paragraphs:
+        matches = create_paragraph_matches_data(df, paragraph_index, recommendations, paragraph,
+                                                include_policy_only, threshold_indices)
+        if not matches.empty:
+            matched.append((paragraph, matches))
+
+    st.write(f"📋 {len(matched)} de {len(paragraphs)} párrafos de la página {page} "
+             f"cruzan con alguna recomendación sobre el umbral")
+
+    for i, (paragraph, matches) in enumerate(matched):
+        paragraph_id = paragraph_index.paragraph_ids[paragraph]
+        with st.expander(f"Párrafo {paragraph_id} - {len(matches)} recomendaciones "
+                         f"(Similitud máxima: {matches['Similitud_Max'].iat[0]:.3f})", expanded=i == 0):
+            # Texto del párrafo desde la primera fila del párrafo en el índice
+            para_text = str(df['paragraph_text'].iat[paragraph_index.rows[paragraph_index.row_ptr[paragraph]]])
+            st.write("**Contenido del Párrafo:**")
+            st.write(para_text[:800] + "..." if len(para_text) > 800 else para_text)
+            st.dataframe(matches, hide_index=True, width='stretch',
+                         column_config={'Similitud_Max': st.column_config.NumberColumn(format="%.3f"),
+                                        'Similitud_Párrafo': st.column_config.NumberColumn(format="%.3f")})
+
+def compute_recommendations_dictionary(histograms, unit_positions, include_policy_only):
+    """Resumen por recomendación para el diccionario, sumando las estadísticas precalculadas por par"""
+    stats = histograms.pair_stats[include_policy_only]
+    sentences = stats['sentences'][unit_positions]
+    total_mentions = sentences.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_similarity = stats['similarity_sum'][unit_positions].sum(axis=0) / total_mentions
+    # fmax ignora los pares sin oraciones (NaN)
+    max_similarity = np.fmax.reduce(stats['similarity_max'][unit_positions], axis=0, initial=np.nan)
+
+    recommendations = histograms.recommendations
+    empty = pd.Series([None] * len(recommendations), dtype=object)
+    recommendations_dict = pd.DataFrame({
+        'Código': recommendations['recommendation_code'].astype(str),
+        'Texto': recommendations['recommendation_text'].astype(str),
+        'Tema': recommendations.get('recommendation_topic', empty).astype(object),
+        # Misma definición de prioridad que los KPI de la ficha (etiqueta Alta/High)
+        'Priorizado_GN': priority_mask(recommendations),
+        'Total_Menciones': total_mentions,
+        'Similitud_Promedio': mean_similarity,
+        'Similitud_Máxima': max_similarity,
+        'Municipios_Implementan': (sentences > 0).sum(axis=0)
+    })
+    recommendations_dict = recommendations_dict[total_mentions > 0]
+    return recommendations_dict.sort_values('Código')
+
+@st.fragment
+def render_recommendations_dictionary(histograms, unit_positions, include_policy_only, selected_municipality):
+    """Diccionario de recomendaciones; la búsqueda y los filtros solo re-ejecutan esta sección"""
+    recommendations_dict = compute_recommendations_dictionary(histograms, unit_positions, include_policy_only)
+
+    # Search and filter options
+    col1, col2, col3 = st.columns([2, 1, 1])
+
+    with col1:
+        search_term = st.text_input(
+            "🔍 Buscar recomendación:",
+            placeholder="Ingrese código o palabras clave...",
+            help="Busque por código de recomendación o palabras en el texto"
+        )
+
+    with col2:
+        if 'recommendation_topic' in histograms.recommendations.columns:
+            available_topics = ['Todos'] + sorted(
+                recommendations_dict['Tema'].dropna().astype(str).unique().tolist())
+            selected_topic = st.selectbox(
+                "Filtrar por tema:",
+                options=available_topics,
+                index=0
+            )
+        else:
+            selected_topic = 'Todos'
+
+    with col3:
+        priority_filter = st.selectbox(
+            "Prioridad GN:",
+            options=['Todos', 'Solo priorizadas', 'Solo no priorizadas'],
+            index=0
+        )
+
+    # Apply filters
+    filtered_dict = recommendations_dict.copy()
+
+    if search_term:
+        mask = (
+                filtered_dict['Código'].str.contains(search_term, case=False, na=False) |
+                filtered_dict['Texto'].str.contains(search_term, case=False, na=False)
+        )
+        filtered_dict = filtered_dict[mask]
+
+    if selected_topic != 'Todos':
+        filtered_dict = filtered_dict[filtered_dict['Tema'] == selected_topic]
+
+    if priority_filter == 'Solo priorizadas':
+        filtered_dict = filtered_dict[filtered_dict['Priorizado_GN']]
+    elif priority_filter == 'Solo no priorizadas':
+        filtered_dict = filtered_dict[~filtered_dict['Priorizado_GN']]
+
+    # Display results count
+    st.markdown(f"**Mostrando {len(filtered_dict)} de {len(recommendations_dict)} recomendaciones**")
+
+    # Display recommendations
+    if not filtered_dict.empty:
+        for idx, row in filtered_dict.iterrows():
+            with st.expander(f"**{row['Código']}** - {row['Texto'][:80]}...", expanded=False):
+                col1, col2 = st.columns([3, 1])
+
+                with col1:
+                    st.markdown("**Descripción completa:**")
+                    st.write(row['Texto'])
+
+                    if pd.notna(row['Tema']):
+                        st.markdown(f"**Tema:** {row['Tema']}")
+
+                with col2:
+                    st.markdown("**Información:**")
+                    st.write(f"**Código:** {row['Código']}")
+
+                    priority_text = "Sí" if row['Priorizado_GN'] else "No"
+                    priority_color = "🔴" if row['Priorizado_GN'] else "⚪"
+                    st.write(f"**Priorizado por GN:** {priority_color} {priority_text}")
+
+                    st.markdown("**Estadísticas:**")
+                    if selected_municipality == 'Todos':
+                        st.write(f"**Municipios que implementan:** {row['Municipios_Implementan']}")
+                    st.write(f"**Total menciones:** {row['Total_Menciones']}")
+                    st.write(f"**Similitud promedio:** {row['Similitud_Promedio']:.3f}")
+                    st.write(f"**Similitud máxima:** {row['Similitud_Máxima']:.3f}")
+    else:
+        st.info("No se encontraron recomendaciones que coincidan con los criterios de búsqueda.")
+
+@dataclass
+class PageData:
+    """Lo que calcula una re-ejecución para los filtros de la sesión; main() lo dibuja y prueba_carga.py lo mide"""
+    data_path: str
+    include_policy_only: bool
+    sentence_threshold: ThresholdProfile
+    tie_method: str
+    tie_breakers: tuple
+    department: str
+    municipality: str
+    histograms: object            # SimilarityHistograms de la versión
+    place_units: np.ndarray       # unidades del filtro de departamento y municipio
+    dictionary_units: np.ndarray  # unidades del diccionario (todas en la vista general)
+    state_key: tuple              # identifica el estado de los filtros en los cálculos cacheados
+    has_rows: bool                # hay filas sobre el umbral para descargar
+    # Ficha (municipio elegido): filas y métricas
+    df: pd.DataFrame = None
+    filtered_df: pd.DataFrame = None
+    high_quality_sentences: pd.DataFrame = None
+    ficha: dict = None
+    # Vista general: totales y mapa
+    summary: dict = None
+    map_figure: tuple = None
+
+def compute_page(data_path, include_policy_only, sentence_threshold, tie_method, tie_breakers,
+                 selected_department, selected_municipality):
+    """Datos de una re-ejecución para los filtros elegidos, sin dibujar; solo la ficha lee las filas"""
+    histograms = load_similarity_histograms(data_path, POLICY_CONFIDENCE_CUTOFF)
+    place_units = histograms.unit_positions(selected_department, selected_municipality)
+    page = PageData(
+        data_path=data_path, include_policy_only=include_policy_only, sentence_threshold=sentence_threshold,
+        tie_method=tie_method, tie_breakers=tie_breakers, department=selected_department,
+        municipality=selected_municipality, histograms=histograms, place_units=place_units,
+        dictionary_units=place_units if selected_municipality != 'Todos' else np.arange(len(histograms.units)),
+        state_key=(data_path, POLICY_CONFIDENCE_CUTOFF, include_policy_only, selected_department,
+                   selected_municipality),
+        # Conteo de los histogramas: no hace falta leer las filas para saber si hay algo que descargar
+        has_rows=bool(histograms.counts_at(place_units, include_policy_only, sentence_threshold).sum() > 0)
     )
 
-    # Municipality filter
-    if selected_department == 'Todos':
-        municipalities = sorted(df['mpio'].unique())
+    if selected_municipality != 'Todos':
+        # Apply policy, department and municipality filters, then the sentence similarity threshold
+        page.df, page.filtered_df, page.high_quality_sentences = select_sentences(
+            data_path, histograms.recommendations, include_policy_only, sentence_threshold,
+            selected_department, selected_municipality)
+
+        # Recomendaciones implementadas (al menos una oración sobre el umbral), todas y prioritarias,
+        # tomadas de los KPIs precalculados: coinciden con el ranking, el mapa y las descargas
+        kpis = load_implementation_kpis(data_path, POLICY_CONFIDENCE_CUTOFF)
+        implemented, priority_implemented = kpis.unit_counts(histograms, place_units, include_policy_only,
+                                                             sentence_threshold)
+        # Ranking position (constant-time lookup on the ranking computed once per filter state)
+        ranking = compute_ranking(data_path, POLICY_CONFIDENCE_CUTOFF, include_policy_only, sentence_threshold,
+                                  tie_method, tie_breakers)
+        page.ficha = {
+            'implementadas': implemented,
+            'prioritarias_implementadas': priority_implemented,
+            'total_recomendaciones': kpis.total_recommendations,
+            'total_prioritarias': kpis.total_priority,
+            'posicion': ranking.position(selected_municipality, selected_department),
+            'total_municipios': len(ranking.table),
+            'percentiles': ranking.peer_percentiles(selected_municipality, selected_department),
+        }
     else:
-        municipalities = sorted(df[df['dpto'] == selected_department]['mpio'].unique())
+        # Summary statistics (de los totales por unidad de los histogramas: la vista general no lee las filas)
+        page.summary = histograms.summary(place_units, include_policy_only)
+        map_values = compute_map_values(data_path, POLICY_CONFIDENCE_CUTOFF, include_policy_only, sentence_threshold)
+        page.map_figure = build_map_figure(data_path, map_values, selected_department)
+    return page
+
+def prepare_export(page, export_store, session_id, export_format, export_columns=None, state=None):
+    """Generar la descarga de los filtros de la página y guardarla en el almacén de la sesión.
+
+    Devuelve (datos, metadatos, sesiones desalojadas); ValueError si supera el tope por sesión.
+    """
+    high_quality_sentences = page.high_quality_sentences
+    if high_quality_sentences is None:
+        # Filas a exportar: política, lugar y umbral de la recomendación de cada fila
+        _, _, high_quality_sentences = select_sentences(
+            page.data_path, page.histograms.recommendations, page.include_policy_only, page.sentence_threshold,
+            page.department, page.municipality)
+
+    # Crear ranking
+    ranking_data = create_ranking_data(page.data_path, page.include_policy_only, page.sentence_threshold,
+                                       page.tie_method, page.tie_breakers)
+
+    # Crear diccionario
+    dict_df = create_variable_dictionary()
+
+    # Generar archivo en el formato elegido
+    export_data, extension, mime = create_export_file(
+        high_quality_sentences, ranking_data, dict_df, export_format, export_columns)
+
+    # Guardar en el almacén de descargas (se libera si la sesión queda inactiva)
+    metadata = {'formato': export_format, 'extension': extension, 'mime': mime,
+                'umbral': page.sentence_threshold.label(), 'registros': len(high_quality_sentences)}
+    evicted = export_store.put(session_id, export_data, metadata,
+                               SESSION_EXPORT_BUDGET_MB * 1024 ** 2, EXPORT_STORE_BUDGET_MB * 1024 ** 2)
+    if evicted:
+        logger.info(f"Descargas de {len(evicted)} sesiones liberadas para respetar el tope de "
+                    f"{EXPORT_STORE_BUDGET_MB} MB")
+    session_usage(state)['descarga_mb'] = len(export_data) / 1024 ** 2
+    return export_data, metadata, evicted
 
-    selected_municipality = st.sidebar.selectbox(
-        "Municipio:",
-        options=['Todos'] + municipalities,
-        index=0
+def main():
+    """Main function to run the Streamlit app"""
+    # Configure the page (aquí y no al importar: los scripts importan este módulo sin abrir una página)
+    st.set_page_config(
+        page_title="Ficha Municipal",
+        page_icon="📋",
+        layout="wide"
     )
+    profile_mark('imports y definiciones')
+
+    # Dataset version (solo se muestra si hay más de una versión en la carpeta de datos)
+    versions = list_dataset_versions()
+    data_path = DATA_PATH if DATA_PATH in versions else versions[0]
+    compare_path = None
+    if len(versions) > 1:
+        st.sidebar.markdown("### 🗂️ Versión de Datos")
+        data_path = st.sidebar.selectbox(
+            "Versión:",
+            options=versions,
+            index=versions.index(data_path),
+            format_func=os.path.basename
+        )
+        compare_options = [None] + [path for path in versions if path != data_path]
+        compare_path = st.sidebar.selectbox(
+            "Comparar con:",
+            options=compare_options,
+            index=0,
+            format_func=lambda path: "Sin comparación" if path is None else os.path.basename(path),
+            help="Muestra movimiento en el ranking, recomendaciones nuevas y cambios de similitud entre versiones"
+        )
+
+    # Load data: con artefactos al día la vista general no lee el dataset (solo la ficha, las descargas y la
+    # comparación de versiones); sin ellos la lectura empieza en segundo plano mientras se dibujan los filtros
+    # Los recursos cacheados se piden siempre con argumentos posicionales para compartir la misma clave
+    places_ready = load_artifact_metadata(data_path, POLICY_CONFIDENCE_CUTOFF) is not None
+    if not places_ready:
+        places_ready = start_data_load(data_path, POLICY_CONFIDENCE_CUTOFF).done()
+
+    # Sidebar for filters
+    st.sidebar.markdown("### 🔧 Configuración de Filtros")
+
+    # Departamento y municipio: si la lista sale de unos datos que aún se leen, se llenan al final
+    department_slot = st.sidebar.empty()
+    municipality_slot = st.sidebar.empty()
 
     # Sentence similarity threshold
-    sentence_threshold = st.sidebar.slider(
+    sentence_threshold = snap_threshold(st.sidebar.slider(
         "Umbral de Similitud de Oraciones:",
         min_value=0.0,
         max_value=1.0,
         value=0.6,
-        step=0.05,
+        step=SIMILARITY_STEP,
         help="Filtro para mostrar solo oraciones con similitud igual o superior al valor seleccionado"
-    )
+    ))
 
     # Policy filter
     include_policy_only = st.sidebar.checkbox(
@@ -256,85 +1793,125 @@ def main():
         help="Filtrar para incluir solo contenido clasificado como política pública"
     )
 
-    # Filter data
-    filtered_df = df.copy()
+    # Ranking settings
+    with st.sidebar.expander("🏆 Criterios del ranking"):
+        tie_method = TIE_METHODS[st.radio(
+            "Posición en empates:",
+            options=list(TIE_METHODS),
+            index=0,
+            help="Municipios con el mismo número de recomendaciones implementadas comparten posición"
+        )]
+        tie_breakers = tuple(st.multiselect(
+            "Desempatar por:",
+            options=list(TIE_BREAKERS),
+            default=[],
+            help="Se aplican en orden; si persiste el empate, los municipios comparten posición"
+        ))
+
+    record_first_paint()
+
+    if not places_ready:
+        department_slot.caption("Cargando departamentos y municipios...")
+    places = load_place_lists(data_path, POLICY_CONFIDENCE_CUTOFF)
+    if places is None:
+        st.stop()
 
-    # Apply policy filter FIRST
-    if include_policy_only:
-        filtered_df = filtered_df[
-            (filtered_df['predicted_class'] == 'Incluida') |
-            ((filtered_df['predicted_class'] == 'Excluida') & (filtered_df['prediction_confidence'] < 0.8))
-            ]
+    # Department filter
+    departments = sorted(places)
+    selected_department = department_slot.selectbox(
+        "Departamento:",
+        options=['Todos'] + departments,
+        index=0
+    )
 
-    # Apply department filter
-    if selected_department != 'Todos':
-        filtered_df = filtered_df[filtered_df['dpto'] == selected_department]
+    # Municipality filter
+    if selected_department == 'Todos':
+        municipalities = sorted({mpio for mpios in places.values() for mpio in mpios})
+    else:
+        municipalities = places[selected_department]
 
-    # Apply municipality filter
-    if selected_municipality != 'Todos':
-        filtered_df = filtered_df[filtered_df['mpio'] == selected_municipality]
+    selected_municipality = municipality_slot.selectbox(
+        "Municipio:",
+        options=['Todos'] + municipalities,
+        index=0
+    )
+    if selected_department != 'Todos':
+        # Lo más probable es abrir una ficha: el dataset se empieza a leer mientras se elige el municipio
+        start_data_load(data_path, POLICY_CONFIDENCE_CUTOFF)
 
-    # Apply sentence similarity filter
-    high_quality_sentences = filtered_df[filtered_df['sentence_similarity'] >= sentence_threshold]
+    # Umbrales por tema o recomendación (perfil guardado o editado; por defecto el umbral general)
+    histograms = load_similarity_histograms(data_path, POLICY_CONFIDENCE_CUTOFF)
+    threshold_profile = render_threshold_profile_editor(histograms.recommendations, sentence_threshold)
+    profile_mark('histogramas')
 
-    # Apply sentence similarity filter
-    high_quality_sentences = filtered_df[filtered_df['sentence_similarity'] >= sentence_threshold]
+    # Cálculos de esta re-ejecución (los mismos que reproduce App/prueba_carga.py)
+    page = compute_page(data_path, include_policy_only, threshold_profile, tie_method, tie_breakers,
+                        selected_department, selected_municipality)
+    profile_mark('datos')
 
     # SISTEMA DE DESCARGA
     st.sidebar.markdown("---")
     st.sidebar.markdown("### 📥 Descargar Datos")
 
-    # Botón 1: Preparar descarga
-    if st.sidebar.button("📊 Preparar Descarga Excel", use_container_width=True):
-        with st.spinner("Generando archivo Excel con 3 pestañas..."):
-            try:
-                # Crear ranking
-                ranking_data = create_ranking_data(df, sentence_threshold, include_policy_only)
+    export_format = st.sidebar.selectbox(
+        "Formato:",
+        options=available_export_formats(),
+        index=0,
+        help="Excel incluye ranking, datos filtrados y diccionario. Los formatos comprimidos reducen el tamaño de la descarga"
+    )
 
-                # Crear diccionario
-                dict_df = create_variable_dictionary()
+    dataset_columns = load_export_columns(data_path, POLICY_CONFIDENCE_CUTOFF)
+    export_columns = st.sidebar.multiselect(
+        "Columnas de datos filtrados:",
+        options=dataset_columns,
+        default=dataset_columns,
+        help="Quitar columnas de texto largo (p. ej. paragraph_text) reduce mucho el tamaño del archivo"
+    )
 
-                # Generar archivo Excel
-                excel_file = create_excel_file(high_quality_sentences, ranking_data, dict_df)
+    # Descargas guardadas fuera de st.session_state, con tope de memoria y liberación por inactividad
+    export_store = get_export_store()
+    session_id = current_session_id()
+    manage_session_memory(export_store, session_id)
 
-                # Guardar en session state
-                st.session_state['excel_ready'] = excel_file
-                st.session_state['umbral_usado'] = sentence_threshold
-                st.session_state['total_registros'] = len(high_quality_sentences)
+    # Botón 1: Preparar descarga
+    if st.sidebar.button("📊 Preparar Descarga", width='stretch'):
+        with st.spinner(f"Generando archivo {export_format}..."):
+            try:
+                # Ranking, diccionario y filas filtradas en el formato elegido, guardados en el almacén
+                _, metadata, _ = prepare_export(page, export_store, session_id, export_format, export_columns)
 
-                st.sidebar.success(f"¡Archivo listo! ({len(high_quality_sentences)} registros filtrados)")
+                st.sidebar.success(f"¡Archivo listo! ({metadata['registros']} registros filtrados)")
 
             except Exception as e:
                 st.sidebar.error(f"Error generando archivo: {str(e)}")
 
     # Botón 2: Descargar (solo aparece si está listo)
-    if 'excel_ready' in st.session_state:
+    prepared = export_store.get(session_id)
+    if prepared is not None:
         from datetime import datetime
+        export_data, metadata = prepared
         fecha_actual = datetime.now().strftime("%Y%m%d_%H%M")
-        umbral = st.session_state.get('umbral_usado', sentence_threshold)
-        total_registros = st.session_state.get('total_registros', 0)
+        umbral = metadata['umbral']
+        extension = metadata['extension']
+        tamano_mb = len(export_data) / 1024 ** 2
 
         st.sidebar.download_button(
-            label=f"⬇️ Descargar Excel ({total_registros} registros)",
-            data=st.session_state['excel_ready'],
-            file_name=f"Reporte_Municipios_Umbral_{umbral}_{fecha_actual}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True,
-            help=f"Excel con ranking, datos filtrados (umbral ≥ {umbral}) y diccionario"
+            label=f"⬇️ Descargar {extension.upper()} ({metadata['registros']} registros, {tamano_mb:.1f} MB)",
+            data=deferred_export(export_store, session_id),
+            file_name=f"Reporte_Municipios_Umbral_{umbral}_{fecha_actual}.{extension}",
+            mime=metadata['mime'],
+            width='stretch',
+            help=f"{metadata['formato']} con datos filtrados (umbral ≥ {umbral})"
         )
 
         # Botón para limpiar y preparar nueva descarga
-        if st.sidebar.button("🔄 Preparar Nueva Descarga", use_container_width=True):
-            if 'excel_ready' in st.session_state:
-                del st.session_state['excel_ready']
-            if 'umbral_usado' in st.session_state:
-                del st.session_state['umbral_usado']
-            if 'total_registros' in st.session_state:
-                del st.session_state['total_registros']
+        if st.sidebar.button("🔄 Preparar Nueva Descarga", width='stretch'):
+            export_store.discard(session_id)
+            session_usage()['descarga_mb'] = 0.0
             st.rerun()
 
     # Mostrar info si no hay datos
-    if high_quality_sentences.empty:
+    if not page.has_rows:
         st.sidebar.info("No hay datos para descargar con el filtro actual")
 
     # ==================================================
@@ -342,7 +1919,7 @@ def main():
     # ==================================================
 
     if selected_municipality != 'Todos':
-        muni_info = filtered_df.iloc[0]
+        muni_info = page.filtered_df.iloc[0]
         municipality_name = selected_municipality
         department_name = muni_info['dpto']
 
@@ -371,6 +1948,7 @@ def main():
                 - **Umbral de similitud:** Ajuste el nivel mínimo de coincidencia entre recomendaciones y texto municipal (entre más alto más calidad tendrán las coincidencias)
                 - **Ranking:** Compare el desempeño relativo entre municipios
                 - **Análisis detallado:** Explore recomendaciones específicas y oraciones relacionadas
+                - **Página/párrafo:** Abra una página del plan y vea las recomendaciones con las que cruza cada párrafo
 
                 **Cómo interpretar los resultados:**
                 - Mayor similitud (0 - 1) indica una coincidencia de mejor calidad entre el texto del PDD y las recomendaciones
@@ -444,47 +2022,29 @@ def main():
 
         st.markdown("### 📈 Análisis de Implementación")
 
-        # Calculate key metrics
-        # Recommendations implemented (at least one sentence above threshold)
-        implemented_recs = high_quality_sentences['recommendation_code'].nunique()
-
-        # Priority recommendations implemented
-        priority_implemented = high_quality_sentences[
-            high_quality_sentences['recommendation_priority_label'].isin(['Alta', 'High'])
-        ]['recommendation_code'].nunique()
-
-        # Calculate ranking
-        ranking_data = df.copy()
-        if include_policy_only:
-            ranking_data = ranking_data[
-                (ranking_data['predicted_class'] == 'Incluida') |
-                ((ranking_data['predicted_class'] == 'Excluida') & (ranking_data['prediction_confidence'] < 0.8))
-                ]
-
-        ranking_data = ranking_data.groupby(['mpio', 'dpto']).agg({
-            'recommendation_code': lambda x: len(set(x[df.loc[x.index, 'sentence_similarity'] >= sentence_threshold]))
-        }).reset_index()
-        ranking_data.columns = ['Municipio', 'Departamento', 'Recomendaciones_Implementadas']
-        ranking_data = ranking_data.sort_values('Recomendaciones_Implementadas', ascending=False)
-        ranking_data['Ranking'] = range(1, len(ranking_data) + 1)
-
-        # Get totals
-        total_municipalities = len(ranking_data)
-        total_recommendations = df['recommendation_code'].nunique()
-
-        current_ranking = ranking_data[ranking_data['Municipio'] == selected_municipality]
-        ranking_position = current_ranking['Ranking'].iloc[0] if not current_ranking.empty else "N/A"
+        # Key metrics (calculadas en compute_page)
+        muni_units = page.place_units
+        implemented_recs = page.ficha['implementadas']
+        priority_implemented = page.ficha['prioritarias_implementadas']
+        ranking_position = page.ficha['posicion']
+        peer_percentiles = page.ficha['percentiles']
+        total_municipalities = page.ficha['total_municipios']
+        total_recommendations = page.ficha['total_recomendaciones']
 
         col1, col2, col3 = st.columns(3)
 
         with col1:
-            ranking_text = f"#{ranking_position}/{total_municipalities}" if ranking_position != "N/A" else "N/A"
+            ranking_text = f"#{ranking_position}/{total_municipalities}" if ranking_position is not None else "N/A"
             st.markdown(f"""
                 <div style="background-color: #fff3e0; padding: 1.5rem; border-radius: 10px; text-align: center;">
                     <h2 style="margin: 0; color: #EF6C00; font-size: 2.5rem;">{ranking_text}</h2>
                     <p style="margin: 0.5rem 0 0 0; color: #EF6C00; font-weight: 500;">Ranking</p>
                 </div>
                 """, unsafe_allow_html=True)
+            if peer_percentiles:
+                st.caption(f"Percentil en su Grupo MDM: {peer_percentiles['Percentil_Grupo_MDM']:.0f} · "
+                           f"entre municipios {'PDET' if muni_info.get('PDET') == 1 else 'no PDET'}: "
+                           f"{peer_percentiles['Percentil_PDET']:.0f}")
 
         with col2:
             recs_text = f"{implemented_recs}/{total_recommendations}"
@@ -498,123 +2058,12 @@ def main():
         with col3:
             st.markdown(f"""
                 <div style="background-color: #e8f5e8; padding: 1.5rem; border-radius: 10px; text-align: center;">
-                    <h2 style="margin: 0; color: #388e3c; font-size: 2.5rem;">{priority_implemented}/45</h2>
+                    <h2 style="margin: 0; color: #388e3c; font-size: 2.5rem;">{priority_implemented}/{page.ficha['total_prioritarias']}</h2>
                     <p style="margin: 0.5rem 0 0 0; color: #388e3c; font-weight: 500;">Prioritarias Implementadas</p>
                 </div>
                 """, unsafe_allow_html=True)
 
-        # Top 5 Recommendations by Frequency Chart
-        st.markdown(" ")
-        st.markdown(" ")
-
-        if not high_quality_sentences.empty:
-            # Header con botón de descarga
-            col_header, col_download = st.columns([4, 1])
-            with col_header:
-                st.markdown("### Top 5 Recomendaciones más Frecuentes")
-            with col_download:
-                # Botón minimalista de descarga
-                st.markdown("""
-                <style>
-                .download-btn {
-                    background: none;
-                    border: 1px solid #e0e0e0;
-                    border-radius: 6px;
-                    padding: 4px 8px;
-                    font-size: 12px;
-                    color: #666;
-                    cursor: pointer;
-                    transition: all 0.2s;
-                }
-                .download-btn:hover {
-                    background: #f8f9fa;
-                    border-color: #007bff;
-                    color: #007bff;
-                }
-                </style>
-                """, unsafe_allow_html=True)
-
-            freq_analysis = high_quality_sentences.groupby('recommendation_code').agg({
-                'sentence_similarity': 'count',
-                'recommendation_text': 'first'
-            }).reset_index()
-            freq_analysis.columns = ['Código', 'Frecuencia', 'Texto']
-            freq_analysis = freq_analysis.sort_values('Frecuencia', ascending=False).head(5)
-
-            if not freq_analysis.empty:
-                with col_download:
-                    csv_freq = to_csv_utf8_bom(freq_analysis)
-                    st.download_button(
-                        label="📄 Descargar",
-                        data=csv_freq,
-                        file_name="top_5_recomendaciones_frecuentes.csv",
-                        mime="text/csv; charset=utf-8",
-                        help="Descargar datos del gráfico",
-                        use_container_width=True
-                    )
-
-                # Gráfico
-                fig_freq = px.bar(
-                    freq_analysis,
-                    x='Frecuencia',
-                    y='Código',
-                    orientation='h',
-                    title='Número de Oraciones por Recomendación',
-                    labels={'Frecuencia': 'Número de Oraciones', 'Código': 'Código de Recomendación'},
-                    color='Frecuencia',
-                    color_continuous_scale='blues',
-                    hover_data={'Texto': True, 'Frecuencia': True}
-                )
-                fig_freq.update_layout(
-                    height=400,
-                    showlegend=False,
-                    coloraxis_showscale=False
-                )
-                st.plotly_chart(fig_freq, use_container_width=True)
-
-        # Implementation Heatmap by Topic
-        if not high_quality_sentences.empty and 'recommendation_topic' in high_quality_sentences.columns:
-            # Header con botón de descarga
-            col_header2, col_download2 = st.columns([4, 1])
-            with col_header2:
-                st.markdown("#### Implementación por Tema")
-
-            topic_analysis = high_quality_sentences.groupby('recommendation_topic')[
-                'recommendation_code'].nunique().reset_index()
-            topic_analysis.columns = ['Tema', 'Recomendaciones_Implementadas']
-            topic_analysis = topic_analysis.sort_values('Recomendaciones_Implementadas', ascending=False)
-
-            if not topic_analysis.empty:
-                with col_download2:
-                    csv_topics = to_csv_utf8_bom(topic_analysis)
-                    st.download_button(
-                        label="📄 Descargar",
-                        data=csv_topics,
-                        file_name="implementacion_por_tema.csv",
-                        mime="text/csv; charset=utf-8",
-                        help="Descargar datos del gráfico",
-                        use_container_width=True
-                    )
-
-                # Gráfico
-                fig_heatmap = px.bar(
-                    topic_analysis,
-                    x='Recomendaciones_Implementadas',
-                    y='Tema',
-                    orientation='h',
-                    title='Recomendaciones Implementadas por Tema',
-                    labels={'Recomendaciones_Implementadas': 'Número de Recomendaciones', 'Tema': ''},
-                    color='Recomendaciones_Implementadas',
-                    color_continuous_scale='viridis'
-                )
-                fig_heatmap.update_layout(
-                    height=400,
-                    showlegend=False,
-                    yaxis={'categoryorder': 'total ascending'},
-                    margin=dict(l=150, r=50, t=80, b=50),
-                    coloraxis_showscale=False
-                )
-                st.plotly_chart(fig_heatmap, use_container_width=True)
+        render_implementation_charts(histograms, muni_units, include_policy_only, threshold_profile)
 
         st.markdown("---")
 
@@ -625,244 +2074,22 @@ def main():
         st.markdown("---")
         st.markdown("### 🔍  Análisis detallado de recomendaciones")
 
-        if not high_quality_sentences.empty:
-            # Recommendation selector (keep original dropdown functionality)
-            available_recommendations = high_quality_sentences['recommendation_code'].unique().tolist()
-
-            selected_rec_code = st.selectbox(
-                "Seleccione una recomendación:",
-                options=available_recommendations,
-                format_func=lambda
-                    x: f"{x} - {high_quality_sentences[high_quality_sentences['recommendation_code'] == x]['recommendation_text'].iloc[0][:60]}...",
-                key="detailed_rec_select",
-                label_visibility="collapsed"  # <- This hides the label but keeps it for accessibility
-            )
-
-            if selected_rec_code:
-                rec_data = high_quality_sentences[
-                    high_quality_sentences['recommendation_code'] == selected_rec_code].copy()
-
-                # Show recommendation text
-                rec_text = rec_data['recommendation_text'].iloc[0]
-                st.markdown("**Texto de la Recomendación:**")
-                st.info(rec_text)
-
-                # Hierarchical navigation tabs
-                tab = st.segmented_control(
-                    "Nivel de análisis:",
-                    ["📝 Párrafos", "💬 Oraciones"],
-                    selection_mode="single",
-                    default="💬 Oraciones",
-                    key="hierarchy_tabs"
-                )
-
-                # TAB 1: PARAGRAPH LEVEL
-                if tab == "📝 Párrafos":
-                    st.markdown("**Análisis por Párrafos:**")
-
-                    # Group by paragraph and calculate paragraph-level similarity
-                    paragraph_analysis = rec_data.groupby(['paragraph_id', 'paragraph_text']).agg({
-                        'paragraph_similarity': 'first',
-                        'page_number': 'first',
-                        'sentence_similarity': ['count', 'mean', 'max'],
-                        'predicted_class': lambda x: x.mode()[0] if not x.empty else 'N/A'
-                    }).reset_index()
-
-                    paragraph_analysis.columns = ['ID_Párrafo', 'Texto_Párrafo', 'Similitud_Párrafo', 'Página',
-                                                  'Num_Oraciones', 'Similitud_Prom', 'Similitud_Max',
-                                                  'Clasificación_ML']
-                    paragraph_analysis = paragraph_analysis.sort_values('Similitud_Prom', ascending=False)
-
-                    # PAGINATION FOR PARAGRAPHS
-                    coincidencias_por_pagina = 5
-                    total_coincidencias = len(paragraph_analysis)
-                    total_paginas = max(1, (total_coincidencias - 1) // coincidencias_por_pagina + 1)
-
-                    # Initialize current page for this recommendation's paragraphs
-                    pagina_key = f'pagina_actual_coincidencias_{selected_rec_code}_parrafos'
-                    if pagina_key not in st.session_state:
-                        st.session_state[pagina_key] = 1
-
-                    # Validate current page doesn't exceed total
-                    if st.session_state[pagina_key] > total_paginas:
-                        st.session_state[pagina_key] = 1
-
-                    pagina_actual = st.session_state[pagina_key]
-
-                    # Apply pagination
-                    inicio = (pagina_actual - 1) * coincidencias_por_pagina
-                    fin = inicio + coincidencias_por_pagina
-                    paragraph_analysis_paginado = paragraph_analysis.iloc[inicio:fin]
-
-                    # Store in session state for pagination controls
-                    st.session_state[f'total_paginas_coincidencias_{selected_rec_code}_parrafos'] = total_paginas
-
-                    # Show pagination info
-                    st.write(
-                        f"📋 Mostrando {len(paragraph_analysis_paginado)} de {total_coincidencias} párrafos (Página {pagina_actual} de {total_paginas})")
-
-                    # Show paginated paragraphs
-                    for idx, row in paragraph_analysis_paginado.iterrows():
-                        with st.expander(
-                                f"Párrafo {row['ID_Párrafo']} - Similitud Promedio: {row['Similitud_Prom']:.3f}",
-                                expanded=idx == paragraph_analysis_paginado.index[0]):  # Only first expanded
-                            col1, col2 = st.columns([3, 1])
-
-                            with col1:
-                                st.write("**Contenido del Párrafo:**")
-                                # Truncate very long text
-                                para_text = row['Texto_Párrafo'][:800] + "..." if len(
-                                    row['Texto_Párrafo']) > 800 else row['Texto_Párrafo']
-                                st.write(para_text)
-
-                            with col2:
-                                st.write("**Métricas:**")
-                                st.write(f"**ID Página:** {row['Página']}")
-                                st.write(f"**ID Párrafo:** {row['ID_Párrafo']}")
-                                st.write(f"**Similitud Párrafo:** {row['Similitud_Párrafo']:.3f}")
-
-                    # Show pagination controls for paragraphs
-                    if total_paginas > 1:
-                        st.markdown("---")
-                        col1, col2, col3 = st.columns([1, 2, 1])
-                        with col2:
-                            cols = st.columns([1, 1, 3, 1, 1])
-
-                            with cols[0]:
-                                if st.button("◀", disabled=(pagina_actual <= 1),
-                                             key=f"prev_page_parrafos_{selected_rec_code}"):
-                                    st.session_state[pagina_key] = max(1, pagina_actual - 1)
-                                    st.rerun()
-
-                            with cols[2]:
-                                paginas_a_mostrar = []
-                                if total_paginas <= 5:
-                                    paginas_a_mostrar = list(range(1, total_paginas + 1))
-                                else:
-                                    if pagina_actual <= 3:
-                                        paginas_a_mostrar = [1, 2, 3, 4, 5]
-                                    elif pagina_actual >= total_paginas - 2:
-                                        paginas_a_mostrar = list(range(total_paginas - 4, total_paginas + 1))
-                                    else:
-                                        paginas_a_mostrar = list(range(pagina_actual - 2, pagina_actual + 3))
-
-                                mini_cols = st.columns(len(paginas_a_mostrar))
-                                for i, pagina in enumerate(paginas_a_mostrar):
-                                    with mini_cols[i]:
-                                        if pagina == pagina_actual:
-                                            st.markdown(
-                                                f"<div style='background: #007bff; color: white; text-align: center; padding: 4px; border-radius: 4px; margin: 2px;'>{pagina}</div>",
-                                                unsafe_allow_html=True)
-                                        else:
-                                            if st.button(str(pagina),
-                                                         key=f"page_parrafos_{selected_rec_code}_{pagina}"):
-                                                st.session_state[pagina_key] = pagina
-                                                st.rerun()
-
-                            with cols[4]:
-                                if st.button("▶", disabled=(pagina_actual >= total_paginas),
-                                             key=f"next_page_parrafos_{selected_rec_code}"):
-                                    st.session_state[pagina_key] = min(total_paginas, pagina_actual + 1)
-                                    st.rerun()
-
-                # TAB 2: SENTENCE LEVEL
-                else:  # "💬 Oraciones"
-                    st.markdown("**Análisis por Oraciones:**")
-
-                    sentence_analysis = rec_data.sort_values('sentence_similarity', ascending=False)
-
-                    # PAGINATION FOR SENTENCES
-                    coincidencias_por_pagina = 5
-                    total_coincidencias = len(sentence_analysis)
-                    total_paginas = max(1, (total_coincidencias - 1) // coincidencias_por_pagina + 1)
-
-                    # Initialize current page for this recommendation's sentences
-                    pagina_key = f'pagina_actual_coincidencias_{selected_rec_code}_oraciones'
-                    if pagina_key not in st.session_state:
-                        st.session_state[pagina_key] = 1
-
-                    # Validate current page doesn't exceed total
-                    if st.session_state[pagina_key] > total_paginas:
-                        st.session_state[pagina_key] = 1
-
-                    pagina_actual = st.session_state[pagina_key]
-
-                    # Apply pagination
-                    inicio = (pagina_actual - 1) * coincidencias_por_pagina
-                    fin = inicio + coincidencias_por_pagina
-                    sentence_analysis_paginado = sentence_analysis.iloc[inicio:fin]
-
-                    # Show pagination info
-                    st.write(
-                        f"📋 Mostrando {len(sentence_analysis_paginado)} de {total_coincidencias} oraciones (Página {pagina_actual} de {total_paginas})")
-
-                    # Show paginated sentences
-                    for idx, (_, row) in enumerate(sentence_analysis_paginado.iterrows()):
-                        sentence_id = row.get('sentence_id_paragraph', f'S{idx + 1}')
-
-                        with st.expander(f"Oración {sentence_id} - Similitud: {row['sentence_similarity']:.3f}",
-                                         expanded=idx == 0):  # Only first expanded
-                            col1, col2 = st.columns([3, 1])
-
-                            with col1:
-                                st.write("**Contenido:**")
-                                st.write(row['sentence_text'])
-
-                            with col2:
-                                st.write("**Métricas:**")
-                                if 'sentence_id' in row and pd.notna(row['sentence_id']):
-                                    st.write(f"**ID Oración:** {row['sentence_id']}")
-                                st.write(f"**ID Página:** {row['page_number']}")
-                                st.write(f"**ID Párrafo:** {row.get('paragraph_id', 'N/A')}")
-                                st.write(f"**Similitud Oración:** {row['sentence_similarity']:.3f}")
-                                st.write(f"**Clasificación ML:** {row['predicted_class']}")
-
-                    # Show pagination controls for sentences
-                    if total_paginas > 1:
-                        st.markdown("---")
-                        col1, col2, col3 = st.columns([1, 2, 1])
-                        with col2:
-                            cols = st.columns([1, 1, 3, 1, 1])
-
-                            with cols[0]:
-                                if st.button("◀", disabled=(pagina_actual <= 1),
-                                             key=f"prev_page_oraciones_{selected_rec_code}"):
-                                    st.session_state[pagina_key] = max(1, pagina_actual - 1)
-                                    st.rerun()
-
-                            with cols[2]:
-                                paginas_a_mostrar = []
-                                if total_paginas <= 5:
-                                    paginas_a_mostrar = list(range(1, total_paginas + 1))
-                                else:
-                                    if pagina_actual <= 3:
-                                        paginas_a_mostrar = [1, 2, 3, 4, 5]
-                                    elif pagina_actual >= total_paginas - 2:
-                                        paginas_a_mostrar = list(range(total_paginas - 4, total_paginas + 1))
-                                    else:
-                                        paginas_a_mostrar = list(range(pagina_actual - 2, pagina_actual + 3))
-
-                                mini_cols = st.columns(len(paginas_a_mostrar))
-                                for i, pagina in enumerate(paginas_a_mostrar):
-                                    with mini_cols[i]:
-                                        if pagina == pagina_actual:
-                                            st.markdown(
-                                                f"<div style='background: #007bff; color: white; text-align: center; padding: 4px; border-radius: 4px; margin: 2px;'>{pagina}</div>",
-                                                unsafe_allow_html=True)
-                                        else:
-                                            if st.button(str(pagina),
-                                                         key=f"page_oraciones_{selected_rec_code}_{pagina}"):
-                                                st.session_state[pagina_key] = pagina
-                                                st.rerun()
-
-                            with cols[4]:
-                                if st.button("▶", disabled=(pagina_actual >= total_paginas),
-                                             key=f"next_page_oraciones_{selected_rec_code}"):
-                                    st.session_state[pagina_key] = min(total_paginas, pagina_actual + 1)
-                                    st.rerun()
+        navigation = st.segmented_control(
+            "Navegar por:",
+            ["🎯 Recomendación", "📄 Página/párrafo"],
+            selection_mode="single",
+            default="🎯 Recomendación",
+            key="navigation_mode",
+            help="Página/párrafo muestra, para cada párrafo del plan, las recomendaciones con las que cruza"
+        )
 
+        if navigation == "📄 Página/párrafo" and len(muni_units) > 0:
+            paragraph_index = load_paragraph_index(data_path, POLICY_CONFIDENCE_CUTOFF)
+            render_paragraph_browser(page.df, paragraph_index, histograms.recommendations, muni_units[0],
+                                     include_policy_only, threshold_profile)
         else:
-            st.info("No hay recomendaciones disponibles con el filtro actual.")
+            render_detailed_analysis(page.high_quality_sentences, histograms.recommendations, page.state_key,
+                                     threshold_profile)
 
     else:
         # VISTA COMPARATIVA - SOLO LAS MÉTRICAS GENERALES
@@ -880,20 +2107,28 @@ def main():
                 </div>
                 """, unsafe_allow_html=True)
 
-        # Summary statistics
+        # Summary statistics (de los totales por unidad de los histogramas: la vista general no lee las filas)
+        summary = page.summary
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Municipios", filtered_df['mpio'].nunique())
+            st.metric("Municipios", summary['municipios'])
         with col2:
-            st.metric("Departamentos", filtered_df['dpto'].nunique())
+            st.metric("Departamentos", summary['departamentos'])
         with col3:
-            st.metric("Recomendaciones", filtered_df['recommendation_code'].nunique())
+            st.metric("Recomendaciones", summary['recomendaciones'])
         with col4:
-            avg_similarity = filtered_df['sentence_similarity'].mean()
-            st.metric("Similitud Promedio", f"{avg_similarity:.3f}")
+            st.metric("Similitud Promedio", f"{summary['similitud_promedio']:.3f}")
 
         st.info("💡 Seleccione un municipio específico en la barra lateral para ver el reporte detallado.")
 
+        # Mapa de municipios
+        st.markdown("### 🗺️ Recomendaciones Implementadas por Municipio")
+        render_municipality_map(page.map_figure)
+
+    if compare_path is not None:
+        render_version_comparison(data_path, compare_path, include_policy_only, threshold_profile,
+                                  selected_department, selected_municipality, tie_method, tie_breakers)
+
     # ==================================================
     # SECTION 4: RECOMMENDATIONS DICTIONARY
     # ==================================================
@@ -901,126 +2136,12 @@ def main():
     st.markdown("---")
     st.markdown("### 📖 Diccionario de Recomendaciones")
 
-    # Create recommendations dictionary from available data
-    if selected_municipality != 'Todos':
-        # Use filtered data for specific municipality
-        dict_data = filtered_df
-    else:
-        # Use all data if viewing comparative mode
-        dict_data = df
-        if include_policy_only:
-            dict_data = dict_data[
-                (dict_data['predicted_class'] == 'Incluida') |
-                ((dict_data['predicted_class'] == 'Excluida') & (dict_data['prediction_confidence'] < 0.8))
-                ]
-
-    # Get unique recommendations with their details
-    recommendations_dict = dict_data.groupby('recommendation_code').agg({
-        'recommendation_text': 'first',
-        'recommendation_topic': 'first',
-        'recommendation_priority': 'first',
-        'sentence_similarity': ['count', 'mean', 'max'],
-        'mpio': lambda x: x.nunique() if selected_municipality == 'Todos' else x.iloc[0]
-    }).reset_index()
-
-    recommendations_dict.columns = ['Código', 'Texto', 'Tema', 'Priorizado_GN', 'Total_Menciones',
-                                    'Similitud_Promedio', 'Similitud_Máxima', 'Municipios_Implementan']
-    recommendations_dict = recommendations_dict.sort_values('Código')
-
-
-    # Get unique recommendations with their details
-    recommendations_dict = dict_data.groupby('recommendation_code').agg({
-        'recommendation_text': 'first',
-        'recommendation_topic': 'first',
-        'recommendation_priority': 'first',
-        'sentence_similarity': ['count', 'mean', 'max'],
-        'mpio': lambda x: x.nunique() if selected_municipality == 'Todos' else x.iloc[0]
-    }).reset_index()
-
-    recommendations_dict.columns = ['Código', 'Texto', 'Tema', 'Priorizado_GN', 'Total_Menciones',
-                                    'Similitud_Promedio', 'Similitud_Máxima', 'Municipios_Implementan']
-    recommendations_dict = recommendations_dict.sort_values('Código')
-
-    # Search and filter options
-    col1, col2, col3 = st.columns([2, 1, 1])
-
-    with col1:
-        search_term = st.text_input(
-            "🔍 Buscar recomendación:",
-            placeholder="Ingrese código o palabras clave...",
-            help="Busque por código de recomendación o palabras en el texto"
-        )
-
-    with col2:
-        if 'recommendation_topic' in dict_data.columns:
-            available_topics = ['Todos'] + sorted(
-                dict_data['recommendation_topic'].dropna().unique().tolist())
-            selected_topic = st.selectbox(
-                "Filtrar por tema:",
-                options=available_topics,
-                index=0
-            )
-        else:
-            selected_topic = 'Todos'
-
-    with col3:
-        priority_filter = st.selectbox(
-            "Prioridad GN:",
-            options=['Todos', 'Solo priorizadas', 'Solo no priorizadas'],
-            index=0
-        )
-
-    # Apply filters
-    filtered_dict = recommendations_dict.copy()
-
-    if search_term:
-        mask = (
-                filtered_dict['Código'].str.contains(search_term, case=False, na=False) |
-                filtered_dict['Texto'].str.contains(search_term, case=False, na=False)
-        )
-        filtered_dict = filtered_dict[mask]
-
-    if selected_topic != 'Todos':
-        filtered_dict = filtered_dict[filtered_dict['Tema'] == selected_topic]
-
-    if priority_filter == 'Solo priorizadas':
-        filtered_dict = filtered_dict[filtered_dict['Priorizado_GN'] == 1]
-    elif priority_filter == 'Solo no priorizadas':
-        filtered_dict = filtered_dict[filtered_dict['Priorizado_GN'] == 0]
-
-    # Display results count
-    st.markdown(f"**Mostrando {len(filtered_dict)} de {len(recommendations_dict)} recomendaciones**")
-
-    # Display recommendations
-    if not filtered_dict.empty:
-        for idx, row in filtered_dict.iterrows():
-            with st.expander(f"**{row['Código']}** - {row['Texto'][:80]}...", expanded=False):
-                col1, col2 = st.columns([3, 1])
+    # Create recommendations dictionary from the precomputed per-unit statistics
+    # (municipio elegido o todas las unidades en la vista general)
+    render_recommendations_dictionary(histograms, page.dictionary_units, include_policy_only, selected_municipality)
 
-                with col1:
-                    st.markdown("**Descripción completa:**")
-                    st.write(row['Texto'])
-
-                    if pd.notna(row['Tema']):
-                        st.markdown(f"**Tema:** {row['Tema']}")
-
-                with col2:
-                    st.markdown("**Información:**")
-                    st.write(f"**Código:** {row['Código']}")
-
-                    if pd.notna(row['Priorizado_GN']):
-                        priority_text = "Sí" if row['Priorizado_GN'] == 1 else "No"
-                        priority_color = "🔴" if row['Priorizado_GN'] == 1 else "⚪"
-                        st.write(f"**Priorizado por GN:** {priority_color} {priority_text}")
-
-                    st.markdown("**Estadísticas:**")
-                    if selected_municipality == 'Todos':
-                        st.write(f"**Municipios que implementan:** {row['Municipios_Implementan']}")
-                    st.write(f"**Total menciones:** {row['Total_Menciones']}")
-                    st.write(f"**Similitud promedio:** {row['Similitud_Promedio']:.3f}")
-                    st.write(f"**Similitud máxima:** {row['Similitud_Máxima']:.3f}")
-    else:
-        st.info("No se encontraron recomendaciones que coincidan con los criterios de búsqueda.")
+    if STARTUP_PROFILE:
+        render_startup_profile()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,369 @@
+"""Datos y artefactos precalculados de la app, sin Streamlit.
+
+Carga compacta del dataset, umbrales sobre la grilla de similitud e histogramas por
+(municipio, recomendación), con su lectura y escritura en Data/artefactos/. Lo usan la
+app y los scripts (precalcular_artefactos.py, prueba_escalamiento.py): importarlo no
+configura ninguna página ni lee datos, así que también sirve en procesos auxiliares.
+"""
+
+import json
+import logging
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from lugares import place_key
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = 'Data'
+DATA_PATH = os.path.join(DATA_DIR, 'Similitudes Jerárquicas Final Econ 2.pkl')
+
+# Regla de política pública: Incluida, o Excluida con confianza menor al corte
+POLICY_CONFIDENCE_CUTOFF = 0.8
+POLICY_FLAG_COLUMN = 'es_politica_publica'
+# Columnas calculadas al cargar que no hacen parte del dataset original (no se exportan)
+DERIVED_COLUMNS = [POLICY_FLAG_COLUMN]
+
+# Umbral de similitud: el control deslizante solo toma valores de esta grilla
+SIMILARITY_STEP = 0.05
+SIMILARITY_GRID = np.round(np.arange(0.0, 1.0 + SIMILARITY_STEP / 2, SIMILARITY_STEP), 2)
+# Artefactos precalculados (App/precalcular_artefactos.py): una carpeta por versión del dataset
+ARTIFACTS_DIR = os.path.join(DATA_DIR, 'artefactos')
+ARTIFACT_FORMAT_VERSION = 3
+ARTIFACT_METADATA_FILE = 'metadata.json'
+
+# Esquema compacto aplicado al cargar los datos
+CATEGORICAL_COLUMNS = [
+    'predicted_class', 'dpto', 'mpio', 'recommendation_code', 'recommendation_topic',
+    'recommendation_text', 'recommendation_priority_label', 'Cat_IICA', 'Grupo_MDM'
+]
+FLAG_COLUMNS = ['PDET', 'recommendation_priority']
+FLOAT32_COLUMNS = ['sentence_similarity', 'paragraph_similarity', 'prediction_confidence']
+# Umbrales contra los que la app compara cada columna; float32 solo se usa si ninguna comparación cambia
+FLOAT32_COMPARISONS = {
+    'sentence_similarity': SIMILARITY_GRID,
+    'prediction_confidence': np.array([POLICY_CONFIDENCE_CUTOFF]),
+}
+
+
+def threshold_index(value):
+    """Posición del umbral en la grilla de similitud"""
+    return int(np.clip(round(value / SIMILARITY_STEP), 0, len(SIMILARITY_GRID) - 1))
+
+
+def snap_threshold(value):
+    """Ajustar un umbral al punto más cercano de la grilla de similitud"""
+    return float(SIMILARITY_GRID[threshold_index(value)])
+
+
+def threshold_indices(values):
+    """Posición en la grilla de un arreglo de umbrales"""
+    return np.clip(np.round(np.asarray(values, dtype='float64') / SIMILARITY_STEP), 0,
+                   len(SIMILARITY_GRID) - 1).astype(int)
+
+
+@dataclass(frozen=True)
+class ThresholdProfile:
+    """Umbral por recomendación: el del código, si no el del tema, si no el umbral general"""
+    default: float
+    by_topic: tuple = ()  # ((tema, umbral), ...)
+    by_code: tuple = ()   # ((recommendation_code, umbral), ...)
+    name: str = ''
+
+    @property
+    def is_uniform(self):
+        return not self.by_topic and not self.by_code
+
+    def label(self):
+        """Texto corto para nombres de archivo y ayudas"""
+        return f"{self.default}" if self.is_uniform else f"{self.default}_{self.name or 'personalizado'}"
+
+    def indices(self, recommendations):
+        """Posición en la grilla del umbral de cada recomendación (mismo orden que la tabla dada)"""
+        thresholds = np.full(len(recommendations), self.default, dtype='float64')
+        for column, overrides in [('recommendation_topic', self.by_topic), ('recommendation_code', self.by_code)]:
+            if overrides and column in recommendations.columns:
+                values = recommendations[column].astype(object).map(dict(overrides)).to_numpy(dtype='float64')
+                thresholds = np.where(np.isnan(values), thresholds, values)
+        return threshold_indices(thresholds)
+
+
+def as_threshold_profile(sentence_threshold):
+    """Aceptar un umbral único o un perfil de umbrales"""
+    if isinstance(sentence_threshold, (int, float, np.floating)):
+        return ThresholdProfile(default=snap_threshold(sentence_threshold))
+    return sentence_threshold
+
+
+def _float32_preserves_comparisons(values, thresholds):
+    """Verificar que pasar a float32 no cambie el resultado de comparar contra ningún umbral"""
+    values = values.to_numpy(dtype='float64')
+    thresholds = np.asarray(thresholds, dtype='float64')
+    # Posición de cada valor respecto a los umbrales, en precisión original y en float32
+    original = np.searchsorted(thresholds, values, side='right')
+    compact = np.searchsorted(thresholds.astype('float32'), values.astype('float32'), side='right')
+    return np.array_equal(original, compact)
+
+
+def optimize_dtypes(df):
+    """Convertir columnas a tipos compactos (category, int8, float32) sin alterar filtros ni agrupaciones"""
+    df = df.copy()
+
+    # Textos de baja cardinalidad -> category (categorías ordenadas, mismo orden que los textos)
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            if df[col].nunique(dropna=True) <= 0.5 * len(df):
+                df[col] = df[col].astype('category')
+
+    # Indicadores 0/1 -> int8 (se conservan las comparaciones == 1 / == 0)
+    for col in FLAG_COLUMNS:
+        if col in df.columns and df[col].notna().all() and df[col].isin([0, 1]).all():
+            df[col] = df[col].astype('int8')
+
+    # Similitudes y confianza -> float32 solo si ningún umbral usado por la app cambia de resultado
+    for col in FLOAT32_COLUMNS:
+        if col in df.columns and pd.api.types.is_float_dtype(df[col]) and df[col].dtype != 'float32':
+            thresholds = FLOAT32_COMPARISONS.get(col)
+            if thresholds is None or _float32_preserves_comparisons(df[col], thresholds):
+                df[col] = df[col].astype('float32')
+            else:
+                logger.info(f"Columna {col} se mantiene en {df[col].dtype}: float32 alteraría algún umbral")
+
+    return df
+
+
+def add_policy_flag(df, policy_cutoff=POLICY_CONFIDENCE_CUTOFF):
+    """Calcular una sola vez la regla de política pública como columna booleana"""
+    predicted_class = df['predicted_class']
+    df[POLICY_FLAG_COLUMN] = (
+        (predicted_class == 'Incluida') |
+        ((predicted_class == 'Excluida') & (df['prediction_confidence'] < policy_cutoff))
+    ).to_numpy(dtype=bool)
+    return df
+
+
+@dataclass
+class SimilarityHistograms:
+    """Conteo de oraciones por (municipio, recomendación) con similitud >= cada umbral de la grilla"""
+    units: pd.DataFrame            # una fila por (mpio, dpto), en el orden de la primera dimensión
+    recommendations: pd.DataFrame  # una fila por recommendation_code, en el orden de la segunda dimensión
+    at_least: dict                 # {solo_politica: array (unidades, recomendaciones, umbrales)}
+    unit_stats: dict               # {solo_politica: {'rows', 'sentences', 'similarity_sum'}} por unidad
+    pair_stats: dict               # {solo_politica: {'rows', 'sentences', 'similarity_sum', 'similarity_max'}} por par
+
+    def unit_positions(self, department, municipality):
+        """Unidades que corresponden a los filtros de departamento y municipio"""
+        mask = np.ones(len(self.units), dtype=bool)
+        if department != 'Todos':
+            mask &= (self.units['dpto'] == department).to_numpy()
+        if municipality != 'Todos':
+            mask &= (self.units['mpio'] == municipality).to_numpy()
+        return np.flatnonzero(mask)
+
+    def counts_at(self, unit_positions, include_policy_only, threshold):
+        """Oraciones con similitud >= umbral por recomendación (suma sobre las unidades)"""
+        indices = as_threshold_profile(threshold).indices(self.recommendations)
+        at_least = self.at_least[include_policy_only][unit_positions]
+        return at_least[:, np.arange(len(indices)), indices].sum(axis=0)
+
+    def distribution(self, unit_positions, include_policy_only):
+        """Oraciones por intervalo de la grilla [umbral_k, umbral_k+1), la última incluye 1.0"""
+        at_least = self.at_least[include_policy_only][unit_positions].sum(axis=(0, 1))
+        return at_least - np.append(at_least[1:], 0)
+
+    def summary(self, unit_positions, include_policy_only):
+        """Municipios, departamentos y recomendaciones con filas, y similitud promedio de esas filas"""
+        unit_stats = self.unit_stats[include_policy_only]
+        units = unit_positions[unit_stats['rows'][unit_positions] > 0]
+        pair_rows = self.pair_stats[include_policy_only]['rows'][units]
+        sentences = unit_stats['sentences'][units].sum()
+        return {
+            'municipios': self.units['mpio'].iloc[units].nunique(),
+            'departamentos': self.units['dpto'].iloc[units].nunique(),
+            'recomendaciones': int((pair_rows.sum(axis=0) > 0).sum()),
+            'similitud_promedio': unit_stats['similarity_sum'][units].sum() / sentences if sentences else np.nan,
+        }
+
+
+def unit_table(df):
+    """Código de unidad (mpio, dpto) de cada fila y tabla de unidades con sus atributos"""
+    unit_keys = df.groupby(['mpio', 'dpto'], observed=True, sort=True)
+    units = unit_keys.agg({
+        'IPM_2018': 'first', 'PDET': 'first', 'Cat_IICA': 'first', 'Grupo_MDM': 'first'
+    }).reset_index()
+    units['place_key'] = [place_key(dpto, mpio) for dpto, mpio in zip(units['dpto'], units['mpio'])]
+    return unit_keys.ngroup().to_numpy(), units
+
+
+def recommendation_table(df):
+    """Código de recomendación de cada fila y tabla de recomendaciones con sus atributos"""
+    rec_keys = df.groupby('recommendation_code', observed=True, sort=True)
+    rec_columns = [col for col in ['recommendation_text', 'recommendation_topic',
+                                   'recommendation_priority', 'recommendation_priority_label']
+                   if col in df.columns]
+    return rec_keys.ngroup().to_numpy(), rec_keys[rec_columns].first().reset_index()
+
+
+def accumulate_similarity(unit_codes, rec_codes, similarity, policy_rows, n_units, n_recommendations):
+    """Conteos y sumas aditivas por (unidad, recomendación), para ambos estados del filtro de política.
+
+    Se pueden calcular por bloques de filas y sumar (el máximo se combina con np.fmax).
+    """
+    # Número de puntos de la grilla <= similitud: la oración supera el umbral k si bins > k
+    grid = SIMILARITY_GRID.astype(similarity.dtype)
+    bins = np.searchsorted(grid, similarity, side='right')
+    has_similarity = ~np.isnan(similarity)
+    bins[~has_similarity] = 0
+    n_bins = len(grid) + 1
+
+    valid = (unit_codes >= 0) & (rec_codes >= 0)
+    pair = unit_codes * n_recommendations + rec_codes
+    n_pairs = n_units * n_recommendations
+    weights = similarity.astype('float64')
+
+    accumulators = {}
+    for include_policy_only in [False, True]:
+        rows = valid & policy_rows if include_policy_only else valid
+        scored = rows & has_similarity
+        unit_rows = (unit_codes >= 0) & (policy_rows if include_policy_only else True)
+        unit_scored = unit_rows & has_similarity
+
+        pair_max = np.full(n_pairs, np.nan)
+        np.fmax.at(pair_max, pair[scored], weights[scored])
+        accumulators[include_policy_only] = {
+            'counts': np.bincount(pair[rows] * n_bins + bins[rows],
+                                  minlength=n_pairs * n_bins).reshape(n_units, n_recommendations, n_bins),
+            'unit_rows': np.bincount(unit_codes[unit_rows], minlength=n_units),
+            'unit_sentences': np.bincount(unit_codes[unit_scored], minlength=n_units),
+            'unit_similarity_sum': np.bincount(unit_codes[unit_scored], weights=weights[unit_scored],
+                                               minlength=n_units),
+            'pair_sentences': np.bincount(pair[scored], minlength=n_pairs).reshape(n_units, n_recommendations),
+            'pair_similarity_sum': np.bincount(pair[scored], weights=weights[scored],
+                                               minlength=n_pairs).reshape(n_units, n_recommendations),
+            'pair_similarity_max': pair_max.reshape(n_units, n_recommendations),
+        }
+    return accumulators
+
+
+def histograms_from_accumulators(units, recommendations, accumulators):
+    """Pasar de conteos por intervalo a conteos acumulados por umbral"""
+    at_least, unit_stats, pair_stats = {}, {}, {}
+    for include_policy_only, acc in accumulators.items():
+        counts = acc['counts']
+        # Sumas acumuladas desde el final: posición k = oraciones con similitud >= grid[k]
+        at_least[include_policy_only] = np.cumsum(counts[:, :, ::-1], axis=2)[:, :, ::-1][:, :, 1:].astype('int32')
+        # Totales por unidad sin umbral (filas, oraciones con similitud y suma de similitudes)
+        unit_stats[include_policy_only] = {
+            'rows': acc['unit_rows'], 'sentences': acc['unit_sentences'],
+            'similarity_sum': acc['unit_similarity_sum']
+        }
+        pair_stats[include_policy_only] = {
+            'rows': counts.sum(axis=2, dtype='int32'), 'sentences': acc['pair_sentences'].astype('int32'), 'similarity_sum': acc['pair_similarity_sum'],
+            'similarity_max': acc['pair_similarity_max']
+        }
+    return SimilarityHistograms(units=units, recommendations=recommendations, at_least=at_least,
+                                unit_stats=unit_stats, pair_stats=pair_stats)
+
+
+def dataset_stem(data_path):
+    """Nombre del archivo sin extensión (también sin .gz: 'x.csv.gz' -> 'x')"""
+    name = os.path.basename(data_path)
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    return os.path.splitext(name)[0]
+
+
+def artifact_dir_for(data_path, artifacts_dir=ARTIFACTS_DIR):
+    """Carpeta de artefactos de una versión del dataset (mismo nombre que el archivo, sin extensión)"""
+    return os.path.join(artifacts_dir, dataset_stem(data_path))
+
+
+def read_artifact_metadata(artifact_dir):
+    """metadata.json de una carpeta de artefactos, o None si no existe o no se puede leer"""
+    try:
+        with open(os.path.join(artifact_dir, ARTIFACT_METADATA_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def find_artifacts(data_path, policy_cutoff):
+    """Carpeta de artefactos utilizable para la versión, o None si falta o está desactualizada"""
+    artifact_dir = artifact_dir_for(data_path)
+    metadata = read_artifact_metadata(artifact_dir)
+    if metadata is None:
+        return None
+
+    # Los artefactos valen solo para el archivo exacto que lee load_data, sin cambios desde que se construyeron
+    # (pueden venir de un CSV o Parquet con el mismo contenido, pero se firman contra ese archivo)
+    dataset = metadata.get('dataset', {})
+    current = (
+        metadata.get('formato') == ARTIFACT_FORMAT_VERSION
+        and metadata.get('corte_politica') == policy_cutoff
+        and metadata.get('grilla') == SIMILARITY_GRID.tolist()
+        and os.path.exists(data_path)
+        and os.path.realpath(dataset.get('ruta', '')) == os.path.realpath(data_path)
+        and list(dataset_signature(data_path)[1:]) == [dataset.get('bytes'), dataset.get('mtime_ns')]
+    )
+    if not current:
+        logger.info(f"Artefactos en {artifact_dir} desactualizados; se calculan desde los datos")
+        return None
+    return artifact_dir
+
+
+def save_artifacts(artifact_dir, histograms, metadata):
+    """Escribir histogramas, tablas y metadatos; la carpeta se reemplaza completa al final"""
+    temp_dir = f"{artifact_dir}.tmp"
+    os.makedirs(temp_dir, exist_ok=True)
+
+    arrays = {}
+    for include_policy_only in [False, True]:
+        flag = int(include_policy_only)
+        arrays[f'at_least_{flag}'] = histograms.at_least[include_policy_only]
+        for group, stats in [('unit', histograms.unit_stats), ('pair', histograms.pair_stats)]:
+            for name, values in stats[include_policy_only].items():
+                arrays[f'{group}_{name}_{flag}'] = values
+    np.savez_compressed(os.path.join(temp_dir, 'histogramas.npz'), **arrays)
+    histograms.units.to_pickle(os.path.join(temp_dir, 'unidades.pkl'))
+    histograms.recommendations.to_pickle(os.path.join(temp_dir, 'recomendaciones.pkl'))
+    with open(os.path.join(temp_dir, ARTIFACT_METADATA_FILE), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+    # Cambio atómico: la app nunca ve una carpeta a medio escribir
+    previous_dir = f"{artifact_dir}.old"
+    if os.path.isdir(artifact_dir):
+        os.replace(artifact_dir, previous_dir)
+    os.replace(temp_dir, artifact_dir)
+    if os.path.isdir(previous_dir):
+        for name in os.listdir(previous_dir):
+            os.remove(os.path.join(previous_dir, name))
+        os.rmdir(previous_dir)
+
+
+def load_artifact_histograms(artifact_dir):
+    """Leer los histogramas precalculados de una carpeta de artefactos"""
+    with np.load(os.path.join(artifact_dir, 'histogramas.npz')) as arrays:
+        arrays = dict(arrays)
+
+    def stats(group, include_policy_only):
+        suffix = f"_{int(include_policy_only)}"
+        prefix = f"{group}_"
+        return {key[len(prefix):-len(suffix)]: values for key, values in arrays.items()
+                if key.startswith(prefix) and key.endswith(suffix)}
+
+    return SimilarityHistograms(
+        units=pd.read_pickle(os.path.join(artifact_dir, 'unidades.pkl')),
+        recommendations=pd.read_pickle(os.path.join(artifact_dir, 'recomendaciones.pkl')),
+        at_least={flag: arrays[f'at_least_{int(flag)}'] for flag in [False, True]},
+        unit_stats={flag: stats('unit', flag) for flag in [False, True]},
+        pair_stats={flag: stats('pair', flag) for flag in [False, True]}
+    )
+
+
+def dataset_signature(data_path):
+    """Ruta, tamaño y fecha de modificación: identifica una versión en los cálculos guardados en disco"""
+    stat = os.stat(data_path)
+    return data_path, stat.st_size, stat.st_mtime_ns
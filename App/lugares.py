@@ -0,0 +1,19 @@
+"""Llaves de lugar compartidas por la app y los scripts de preparación.
+
+Este módulo no importa Streamlit: los scripts lo usan sin ejecutar la página.
+"""
+
+import unicodedata
+
+GEOMETRY_PATH = 'Data/municipios_simplificados.geojson'
+
+
+def normalize_place_name(name):
+    """Nombre en mayúsculas, sin tildes ni espacios repetidos, para cruzar con los límites municipales"""
+    text = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(text.upper().split())
+
+
+def place_key(department, municipality):
+    """Llave departamento|municipio que identifica cada polígono del mapa"""
+    return f"{normalize_place_name(department)}|{normalize_place_name(municipality)}"
@@ -0,0 +1,219 @@
+"""Precalcular los artefactos de la app para una versión del dataset.
+
+Lee el dataset una sola vez y por bloques: CSV y Parquet se leen en streaming, así que
+el archivo puede ser más grande que la memoria. Un .pkl no se puede leer por partes: se
+carga completo, así que solo sirve para datasets que caben en memoria. Cada bloque se
+agrega en un proceso aparte y los resultados se suman en Data/artefactos/<versión>/:
+histogramas de similitud por municipio y recomendación, tablas de municipios y
+recomendaciones y un metadata.json (con las columnas del dataset). Los artefactos se firman con
+el tamaño y la fecha del .pkl que lee la app: la app los usa solo mientras ese archivo
+no cambie. Si la entrada es CSV o Parquet, --dataset-app indica el .pkl con el mismo
+contenido.
+
+Uso (desde la raíz del repositorio):
+    python App/precalcular_artefactos.py "Data/Similitudes Jerárquicas Final Econ 2.parquet" \
+        --dataset-app "Data/Similitudes Jerárquicas Final Econ 2.pkl" --procesos 4
+"""
+
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from artefactos import (ARTIFACT_FORMAT_VERSION, DERIVED_COLUMNS, POLICY_CONFIDENCE_CUTOFF, POLICY_FLAG_COLUMN,
+                        SIMILARITY_GRID, accumulate_similarity, add_policy_flag, artifact_dir_for,
+                        dataset_signature, dataset_stem, histograms_from_accumulators, recommendation_table,
+                        save_artifacts, unit_table)
+
+# Columnas que necesitan los artefactos; el resto (textos de oraciones y párrafos) no se lee
+SOURCE_COLUMNS = [
+    'mpio', 'dpto', 'recommendation_code', 'recommendation_text', 'recommendation_topic',
+    'recommendation_priority', 'recommendation_priority_label', 'sentence_similarity',
+    'predicted_class', 'prediction_confidence', 'IPM_2018', 'PDET', 'Cat_IICA', 'Grupo_MDM'
+]
+
+
+def read_chunks(path, chunk_rows):
+    """(todas las columnas del dataset, bloques de filas con solo las columnas necesarias)"""
+    lower = path.lower()
+    if lower.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(path)
+        names = parquet.schema_arrow.names
+        columns = [col for col in SOURCE_COLUMNS if col in names]
+        return names, (batch.to_pandas() for batch in parquet.iter_batches(batch_size=chunk_rows, columns=columns))
+    if lower.endswith(('.csv', '.csv.gz')):
+        # utf-8-sig: los CSV que exporta la app llevan BOM
+        names = pd.read_csv(path, nrows=0, encoding='utf-8-sig').columns.tolist()
+        return names, pd.read_csv(path, chunksize=chunk_rows, encoding='utf-8-sig',
+                                  usecols=lambda col: col in SOURCE_COLUMNS)
+
+    # Un pickle no se puede leer por partes: se carga completo (necesita memoria para todo el archivo)
+    # y se recorre por bloques
+    df = pd.read_pickle(path)
+    names = df.columns.tolist()
+    df = df[[col for col in SOURCE_COLUMNS if col in df.columns]]
+    return names, (df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows))
+
+
+def aggregate_chunk(chunk, policy_cutoff):
+    """Agregados aditivos de un bloque, con sus propias tablas de municipios y recomendaciones"""
+    chunk = add_policy_flag(chunk.copy(), policy_cutoff)
+    unit_codes, units = unit_table(chunk)
+    rec_codes, recommendations = recommendation_table(chunk)
+    accumulators = accumulate_similarity(unit_codes, rec_codes,
+                                         chunk['sentence_similarity'].to_numpy(dtype='float64'),
+                                         chunk[POLICY_FLAG_COLUMN].to_numpy(), len(units), len(recommendations))
+    return units, recommendations, accumulators
+
+
+class ArtifactAccumulator:
+    """Suma los agregados de cada bloque sobre las unidades y recomendaciones vistas hasta el momento"""
+
+    def __init__(self):
+        self.units = None
+        self.recommendations = None
+        self.arrays = None
+
+    @staticmethod
+    def _merge_table(table, new):
+        """Agregar las filas nuevas y completar atributos faltantes; devuelve la posición de cada fila nueva"""
+        if table is None:
+            return new, np.arange(len(new))
+        table = pd.concat([table, new[~new.index.isin(table.index)]])
+        if table.isna().any().any():
+            table = table.fillna(new.reindex(table.index))
+        return table, table.index.get_indexer(new.index)
+
+    def add(self, units, recommendations, accumulators):
+        self.units, unit_map = self._merge_table(self.units, units.set_index(['mpio', 'dpto']))
+        self.recommendations, rec_map = self._merge_table(self.recommendations,
+                                                          recommendations.set_index('recommendation_code'))
+        if self.arrays is None:
+            self.arrays = {flag: {name: np.zeros((0,) * min(values.ndim, 2) + values.shape[2:],
+                                                 dtype='float64' if name.endswith(('_sum', '_max')) else 'int64')
+                                  for name, values in acc.items()}
+                           for flag, acc in accumulators.items()}
+
+        pair_index = (unit_map[:, None], rec_map[None, :])
+        for flag, acc in accumulators.items():
+            for name, values in acc.items():
+                total = self.arrays[flag][name]
+                pad = [(0, len(self.units) - total.shape[0])]
+                if total.ndim > 1:
+                    pad.append((0, len(self.recommendations) - total.shape[1]))
+                pad += [(0, 0)] * (total.ndim - len(pad))
+                total = np.pad(total, pad, constant_values=np.nan if name.endswith('_max') else 0)
+
+                index = pair_index if values.ndim > 1 else unit_map
+                if name.endswith('_max'):
+                    total[index] = np.fmax(total[index], values)
+                else:
+                    total[index] += values
+                self.arrays[flag][name] = total
+
+    def histograms(self):
+        """Histogramas finales, con unidades y recomendaciones en el mismo orden que calcula la app"""
+        units = self.units.reset_index()
+        recommendations = self.recommendations.reset_index()
+        unit_order = np.lexsort((units['dpto'].astype(str), units['mpio'].astype(str)))
+        rec_order = np.argsort(recommendations['recommendation_code'].astype(str).to_numpy(), kind='stable')
+
+        accumulators = {
+            flag: {name: values[unit_order][:, rec_order] if values.ndim > 1 else values[unit_order]
+                   for name, values in acc.items()}
+            for flag, acc in self.arrays.items()
+        }
+        return histograms_from_accumulators(units.iloc[unit_order].reset_index(drop=True),
+                                            recommendations.iloc[rec_order].reset_index(drop=True),
+                                            accumulators)
+
+
+def run_pipeline(path, chunk_rows, processes, policy_cutoff):
+    """Leer el dataset por bloques y agregarlo; devuelve (histogramas, filas, bloques, columnas del dataset)"""
+    accumulator = ArtifactAccumulator()
+    rows = chunks = 0
+    columns, source = read_chunks(path, chunk_rows)
+
+    if processes <= 1:
+        for chunk in source:
+            rows, chunks = rows + len(chunk), chunks + 1
+            accumulator.add(*aggregate_chunk(chunk, policy_cutoff))
+        return accumulator.histograms(), rows, chunks, columns
+
+    # Como máximo dos bloques en espera por proceso: la memoria no crece con el tamaño del archivo.
+    # Los resultados se suman en el orden de lectura, así el resultado no depende de qué proceso termine primero
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = deque()
+        for chunk in source:
+            rows, chunks = rows + len(chunk), chunks + 1
+            pending.append(pool.submit(aggregate_chunk, chunk, policy_cutoff))
+            if len(pending) >= 2 * processes:
+                accumulator.add(*pending.popleft().result())
+        while pending:
+            accumulator.add(*pending.popleft().result())
+    return accumulator.histograms(), rows, chunks, columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precalcular los artefactos de la app para una versión del dataset")
+    parser.add_argument('entrada', help="Dataset de origen (.parquet, .csv, .csv.gz o .pkl). Parquet y CSV se leen "
+                                        "por bloques; un .pkl se carga completo en memoria, así que para "
+                                        "datasets más grandes que la memoria use Parquet o CSV")
+    parser.add_argument('--dataset-app', help="Archivo .pkl que lee la app con el mismo contenido que la entrada "
+                                              "(por defecto la entrada, si es .pkl)")
+    parser.add_argument('--salida', help="Carpeta de artefactos (por defecto Data/artefactos/<nombre del dataset>)")
+    parser.add_argument('--filas-por-bloque', type=int, default=500_000, help="Filas leídas por bloque")
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 1, help="Procesos para agregar bloques")
+    parser.add_argument('--corte-politica', type=float, default=POLICY_CONFIDENCE_CUTOFF,
+                        help="Corte de confianza de la regla de política pública")
+    args = parser.parse_args()
+
+    dataset_path = args.dataset_app or (args.entrada if args.entrada.lower().endswith('.pkl') else None)
+    if dataset_path is None:
+        parser.error("con una entrada CSV o Parquet indique con --dataset-app el .pkl que lee la app")
+    if not os.path.exists(dataset_path):
+        parser.error(f"no existe el dataset de la app '{dataset_path}'")
+
+    start = time.perf_counter()
+    histograms, rows, chunks, columns = run_pipeline(args.entrada, args.filas_por_bloque, args.procesos, args.corte_politica)
+    elapsed = time.perf_counter() - start
+
+    _, size, mtime_ns = dataset_signature(args.entrada)
+    _, dataset_size, dataset_mtime_ns = dataset_signature(dataset_path)
+    units = histograms.units
+    metadata = {
+        'formato': ARTIFACT_FORMAT_VERSION,
+        'version': dataset_stem(dataset_path),
+        'fuente': {'ruta': args.entrada, 'bytes': size, 'mtime_ns': mtime_ns},
+        # Archivo que lee la app: la app usa los artefactos solo si sigue igual
+        'dataset': {'ruta': dataset_path, 'bytes': dataset_size, 'mtime_ns': dataset_mtime_ns},
+        'corte_politica': args.corte_politica,
+        'grilla': SIMILARITY_GRID.tolist(),
+        'construido': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'filas': rows,
+        'bloques': chunks,
+        'procesos': args.procesos,
+        'segundos': round(elapsed, 1),
+        'unidades': len(units),
+        'recomendaciones': len(histograms.recommendations),
+        # Columnas exportables: la app arma el selector de descargas sin leer el dataset
+        'columnas': [col for col in columns if col not in DERIVED_COLUMNS],
+        'municipios_por_departamento': {
+            str(dpto): sorted(group['mpio'].astype(str).tolist())
+            for dpto, group in units.groupby(units['dpto'].astype(str), sort=True)
+        },
+    }
+
+    output_dir = args.salida or artifact_dir_for(dataset_path)
+    save_artifacts(output_dir, histograms, metadata)
+    print(f"{rows:,} filas en {chunks} bloques ({elapsed:.1f} s, {args.procesos} procesos) -> {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
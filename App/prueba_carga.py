@@ -0,0 +1,296 @@
+"""Prueba de carga local de la app con usuarios virtuales concurrentes.
+
+Cada usuario virtual reproduce una secuencia de interacciones con los widgets
+(departamento -> municipio -> umbral -> paginar -> exportar) llamando, en su propio
+hilo y sin candados, a las funciones de la app que main() y sus fragmentos usan en
+cada re-ejecución: compute_page (filtros, ranking, KPIs, mapa), los gráficos, la
+paginación, el diccionario y prepare_export con el almacén de descargas compartido.
+Cada usuario tiene su propio diccionario de estado en lugar de st.session_state.
+Todos los hilos comparten los cachés del proceso, como las sesiones de un servidor
+real; no se mide el dibujo de los elementos en el navegador.
+
+Las secuencias se generan con una semilla y se pueden guardar en JSON (--guardar-secuencias)
+para reproducir exactamente la misma carga después (--secuencias). Antes de medir se
+ejecuta una sesión de calentamiento (carga de datos y precálculos); el crecimiento de
+memoria por sesión se calcula desde la memoria después del calentamiento. Al final se
+reporta latencia por paso (p50/p95/p99), rendimiento, memoria y el uso del almacén de
+descargas (bytes y desalojos).
+
+Uso (desde la raíz del repositorio, con los datos en Data/):
+    python App/prueba_carga.py --usuarios 8 --iteraciones 3 --guardar-secuencias carga.json
+    python App/prueba_carga.py --secuencias carga.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+from streamlit.logger import set_log_level
+
+import app_mpios_priorizados as app
+
+STEPS = ['inicio', 'departamento', 'municipio', 'umbral', 'politica', 'paginar', 'exportar']
+THRESHOLD_CHOICES = [0.5, 0.55, 0.6, 0.65, 0.7]
+
+
+def rss_mb():
+    """Memoria residente del proceso en MB (Linux); en otros sistemas, el pico de memoria"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss está en bytes en macOS y en KB en Linux
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def generate_sequence(places, rng, args):
+    """Interacciones de un usuario: [{'paso': ..., 'valor': ...}, ...] con valores válidos para los widgets"""
+    formats = app.available_export_formats()
+    sequence = [{'paso': 'inicio', 'valor': None}]
+    for _ in range(args.iteraciones):
+        department = rng.choice(sorted(places))
+        sequence.append({'paso': 'departamento', 'valor': department})
+        sequence.append({'paso': 'municipio', 'valor': rng.choice(places[department])})
+        sequence.append({'paso': 'umbral', 'valor': rng.choice(THRESHOLD_CHOICES)})
+        if rng.random() < args.politica:
+            sequence.append({'paso': 'politica', 'valor': rng.random() < 0.5})
+        sequence += [{'paso': 'paginar', 'valor': None}] * args.paginas
+        if rng.random() < args.exportar:
+            sequence.append({'paso': 'exportar', 'valor': rng.choice(formats)})
+        if args.pausa:
+            sequence.append({'paso': 'pausa', 'valor': rng.uniform(0, 2 * args.pausa)})
+    return sequence
+
+
+class VirtualSession:
+    """Estado de los widgets de una sesión y las funciones que main() llama en cada re-ejecución"""
+
+    def __init__(self, session_id, data_path, export_store):
+        self.session_id = session_id
+        self.data_path = data_path
+        self.export_store = export_store
+        self.widgets = {'departamento': 'Todos', 'municipio': 'Todos', 'umbral': 0.6, 'politica': True}
+        self.state = {}  # hace las veces de st.session_state (páginas y contadores de memoria)
+        self.page = None  # PageData de la última re-ejecución
+        self.evictions = {'almacen': 0, 'rechazada': 0}
+
+    def apply(self, step, value):
+        """Aplicar una interacción y ejecutar lo que la app re-ejecuta por ella"""
+        if step == 'paginar':
+            # La paginación solo re-ejecuta el fragmento del análisis detallado
+            return self.next_page()
+        if step == 'exportar':
+            self.rerun()
+            return self.export(value)
+        if step == 'departamento':
+            self.widgets['municipio'] = 'Todos'
+        if step in self.widgets:
+            self.widgets[step] = value
+        return self.rerun()
+
+    def rerun(self):
+        cutoff = app.POLICY_CONFIDENCE_CUTOFF
+        department, municipality = self.widgets['departamento'], self.widgets['municipio']
+        include_policy_only = self.widgets['politica']
+        threshold = app.build_threshold_profile(self.widgets['umbral'], {}, {})
+
+        app.manage_session_memory(self.export_store, self.session_id, self.state)
+        app.load_place_lists(self.data_path, cutoff)
+        page = app.compute_page(self.data_path, include_policy_only, threshold, app.DEFAULT_TIE_METHOD, (),
+                                department, municipality)
+        self.page = page
+        if municipality != 'Todos':
+            app.compute_implementation_charts(page.histograms, page.place_units, include_policy_only, threshold)
+            self.detailed_page()
+        app.compute_recommendations_dictionary(page.histograms, page.dictionary_units, include_policy_only)
+        return page
+
+    def detailed_page(self):
+        """Página actual de coincidencias por oración de la primera recomendación (solo en la ficha)"""
+        page = self.page
+        if page is None or page.high_quality_sentences is None or page.high_quality_sentences.empty:
+            return None
+        rec_code = page.high_quality_sentences['recommendation_code'].iat[0]
+        return app.recommendation_matches_page(page.high_quality_sentences, page.state_key, page.sentence_threshold,
+                                               rec_code, 'oraciones', state=self.state)
+
+    def next_page(self):
+        """Botón de página siguiente del análisis detallado, luego la re-ejecución del fragmento"""
+        current = self.detailed_page()
+        if current is None:
+            return None
+        _, pagina_key, _, pagina_actual, total_paginas = current
+        app._ir_a_pagina(pagina_key, min(total_paginas, pagina_actual + 1), self.state)
+        return self.detailed_page()
+
+    def export(self, export_format):
+        """Preparar la descarga y guardarla en el almacén compartido, como el botón de la barra lateral"""
+        try:
+            data, _, evicted = app.prepare_export(self.page, self.export_store, self.session_id, export_format,
+                                                  state=self.state)
+        except ValueError:
+            # La app muestra el error y no guarda nada: la descarga supera el máximo por sesión
+            self.evictions['rechazada'] += 1
+            return None
+        self.evictions['almacen'] += len(evicted)
+        return data
+
+
+def replay(session, sequence, timings, errors):
+    """Reproducir una secuencia de interacciones; registra la latencia de cada paso"""
+    for event in sequence:
+        step, value = event['paso'], event['valor']
+        if step == 'pausa':
+            time.sleep(value)
+            continue
+        start = time.perf_counter()
+        try:
+            session.apply(step, value)
+        except Exception as e:
+            errors.append(f"{session.session_id} en {step}={value!r}: {e!r}")
+            return
+        timings.append((step, time.perf_counter() - start))
+
+
+def virtual_user(user_id, sequence, data_path, export_store, results):
+    """Un usuario virtual en su propio hilo; guarda latencias, errores y desalojos"""
+    session = VirtualSession(f'usuario-{user_id}', data_path, export_store)
+    timings, errors = [], []
+    replay(session, sequence, timings, errors)
+    results[user_id] = {'timings': timings, 'errors': errors, 'evictions': session.evictions,
+                        'descarga_mb': export_store.nbytes(session.session_id) / 1024 ** 2}
+
+
+def summarize(results, elapsed, rss_start, rss_end, users, export_store, warm):
+    """Percentiles de latencia por paso, rendimiento, memoria y almacén de descargas"""
+    timings = [timing for result in results.values() for timing in result['timings']]
+    steps = {}
+    for step in STEPS:
+        latencies = np.array([seconds for name, seconds in timings if name == step])
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            steps[step] = {'n': len(latencies), 'p50': p50, 'p95': p95, 'p99': p99, 'max': latencies.max()}
+
+    downloads = [result['descarga_mb'] for result in results.values()]
+    evictions = {}
+    for result in results.values():
+        for reason, count in result['evictions'].items():
+            evictions[reason] = evictions.get(reason, 0) + count
+    return {
+        'usuarios': users,
+        'calentamiento': warm,
+        'interacciones': len(timings),
+        'segundos': elapsed,
+        'interacciones_por_segundo': len(timings) / elapsed if elapsed else 0.0,
+        'pasos': steps,
+        'rss_inicial_mb': rss_start,
+        'rss_final_mb': rss_end,
+        'crecimiento_por_sesion_mb': (rss_end - rss_start) / users,
+        'almacen_descargas_mb': export_store.nbytes() / 1024 ** 2,
+        'descarga_mb_promedio': float(np.mean(downloads)) if downloads else 0.0,
+        'descarga_mb_max': float(np.max(downloads)) if downloads else 0.0,
+        'desalojos': evictions,
+        'errores': [error for result in results.values() for error in result['errors']],
+    }
+
+
+def print_summary(summary):
+    print(f"\n{summary['usuarios']} usuarios, {summary['interacciones']} interacciones en "
+          f"{summary['segundos']:.1f} s ({summary['interacciones_por_segundo']:.2f} interacciones/s)\n")
+    print(f"{'paso':<14}{'n':>6}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'máx (s)':>10}")
+    for step, stats in summary['pasos'].items():
+        print(f"{step:<14}{stats['n']:>6}{stats['p50']:>10.3f}{stats['p95']:>10.3f}"
+              f"{stats['p99']:>10.3f}{stats['max']:>10.3f}")
+    start = "después del calentamiento" if summary['calentamiento'] else "sin calentamiento, incluye la carga de datos"
+    print(f"\nMemoria del proceso ({start}): {summary['rss_inicial_mb']:.0f} MB -> {summary['rss_final_mb']:.0f} MB "
+          f"({summary['crecimiento_por_sesion_mb']:+.1f} MB por sesión)")
+    print(f"Almacén de descargas: {summary['almacen_descargas_mb']:.1f} MB; por sesión "
+          f"{summary['descarga_mb_promedio']:.2f} MB en promedio, {summary['descarga_mb_max']:.2f} MB máximo")
+    if any(summary['desalojos'].values()):
+        print("Desalojos: " + ", ".join(f"{reason}={count}" for reason, count in summary['desalojos'].items()))
+    for error in summary['errores']:
+        print(f"ERROR {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga con usuarios virtuales concurrentes")
+    parser.add_argument('--usuarios', type=int, default=4, help="Usuarios virtuales simultáneos")
+    parser.add_argument('--iteraciones', type=int, default=2, help="Recorridos del flujo por usuario")
+    parser.add_argument('--paginas', type=int, default=2, help="Clics de página siguiente por recorrido")
+    parser.add_argument('--exportar', type=float, default=0.5, help="Probabilidad de exportar en cada recorrido")
+    parser.add_argument('--politica', type=float, default=0.2,
+                        help="Probabilidad de cambiar el filtro de política pública en cada recorrido")
+    parser.add_argument('--pausa', type=float, default=0.0, help="Pausa promedio entre recorridos (s)")
+    parser.add_argument('--secuencias', help="Reproducir las secuencias guardadas en este JSON (una por usuario)")
+    parser.add_argument('--guardar-secuencias', help="Guardar en este JSON las secuencias reproducidas")
+    parser.add_argument('--sin-calentar', action='store_true',
+                        help="No ejecutar la sesión de calentamiento: la carga de datos cuenta en la medición")
+    parser.add_argument('--directorio', default='.', help="Carpeta que contiene Data/ (por defecto la actual)")
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--json', help="Guardar el resumen en este archivo")
+    args = parser.parse_args()
+
+    # La app lee Data/ con rutas relativas; sin servidor, Streamlit avisa en cada llamada cacheada
+    os.chdir(args.directorio)
+    set_log_level('error')
+
+    versions = app.list_dataset_versions()
+    if not versions:
+        raise SystemExit(f"No hay datasets en {app.DATA_DIR}")
+    data_path = app.DATA_PATH if app.DATA_PATH in versions else versions[0]
+
+    if args.secuencias:
+        with open(args.secuencias, encoding='utf-8') as f:
+            sequences = json.load(f)['usuarios']
+    else:
+        places = app.load_place_lists(data_path, app.POLICY_CONFIDENCE_CUTOFF)
+        sequences = [generate_sequence(places, random.Random(args.semilla + user_id), args)
+                     for user_id in range(args.usuarios)]
+    if args.guardar_secuencias:
+        with open(args.guardar_secuencias, 'w', encoding='utf-8') as f:
+            json.dump({'dataset': os.path.basename(data_path), 'usuarios': sequences}, f, ensure_ascii=False, indent=1)
+
+    export_store = app.get_export_store()
+    warm = not args.sin_calentar
+    if warm:
+        # Carga de datos y precálculos compartidos fuera de la medición
+        # (la vista general y la ficha): la primera secuencia hasta su primer municipio
+        prefix = []
+        for event in sequences[0]:
+            if event['paso'] not in ('pausa', 'exportar'):
+                prefix.append(event)
+            if event['paso'] == 'municipio':
+                break
+        warm_up_errors = []
+        replay(VirtualSession('calentamiento', data_path, export_store), prefix, [], warm_up_errors)
+        if warm_up_errors:
+            raise SystemExit(f"Falló el calentamiento: {warm_up_errors[0]}")
+
+    results = {}
+    threads = [threading.Thread(target=virtual_user, args=(user_id, sequence, data_path, export_store, results))
+               for user_id, sequence in enumerate(sequences)]
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results, elapsed, rss_start, rss_mb(), len(sequences), export_store, warm)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2, default=float)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+"""Prueba de escalamiento de memoria y latencia con datasets sintéticos más grandes.
+
+Genera datasets con el esquema de la app a varias escalas del volumen actual (por defecto
+1×, 10× y 50×): las filas crecen con la escala y las recomendaciones con su raíz cuadrada,
+como al sumar planes departamentales y nuevas recomendaciones. Cada escala se mide en un
+proceso aparte, así la memoria pico es la de la app con ese dataset: carga, precálculo,
+filtros, ranking, agregados de la ficha y exportación (la del municipio en cada repetición
+y, una vez por escala, la de la selección general en Excel y en CSV comprimido).
+
+Imprime la curva de escalamiento (latencia y memoria pico por escala), el exponente de
+crecimiento de cada operación y la escala a la que se superaría cada límite, incluido el
+máximo de filas de una hoja de Excel. Termina con código 1 si alguna medición supera su
+límite o si la selección general ya no cabe en Excel.
+
+Uso (desde la raíz del repositorio):
+    python App/prueba_escalamiento.py --escalas 1 10 50 --json escalamiento.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# Límites por operación en segundos (el peor caso de las repeticiones) y de memoria pico del proceso
+LATENCY_LIMITS = {
+    'carga': 120.0,
+    'precalculo': 120.0,
+    'filtro_general': 2.0,
+    'filtro_municipio': 1.0,
+    'ranking': 1.0,
+    'ficha': 1.0,
+    'exportar': 30.0,
+    'excel_general': 300.0,
+    'csv_gz_general': 120.0,
+}
+MAX_RSS_MB = 4096
+# Volumen de referencia si no hay dataset en Data/ ni artefactos con sus conteos
+DEFAULT_VOLUME = {'filas': 200_000, 'municipios': 1_100, 'recomendaciones': 80}
+
+RESULT_PREFIX = 'RESULTADO '
+MAX_REPORTED_SCALE = 10_000  # más allá, la extrapolación no dice nada útil
+ROWS_PER_SENTENCE = 4       # recomendaciones que cruza cada oración
+SENTENCES_PER_PARAGRAPH = 5
+PARAGRAPHS_PER_PAGE = 6
+DEPARTMENTS = 32
+TOPICS = ['Salud', 'Educación', 'Agua', 'Vías', 'Paz', 'Economía', 'Ambiente', 'Gobierno']
+FILLER = ("para fortalecer la gestión territorial se implementarán programas de inversión pública "
+          "con participación comunitaria, seguimiento a metas y articulación con el nivel nacional ") * 4
+
+
+def peak_rss_mb():
+    """Memoria pico del proceso en MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss está en bytes en macOS y en KB en Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def current_volume(data_path, artifact_dir):
+    """Filas, municipios y recomendaciones del dataset actual (de los artefactos si existen)"""
+    try:
+        with open(os.path.join(artifact_dir, 'metadata.json'), encoding='utf-8') as f:
+            metadata = json.load(f)
+        return {'filas': metadata['filas'], 'municipios': metadata['unidades'],
+                'recomendaciones': metadata['recomendaciones']}
+    except (OSError, ValueError, KeyError):
+        pass
+    if not os.path.exists(data_path):
+        return None
+    df = pd.read_pickle(data_path)
+    return {'filas': len(df), 'municipios': len(df[['mpio', 'dpto']].drop_duplicates()),
+            'recomendaciones': df['recommendation_code'].nunique()}
+
+
+def scaled_volume(base, scale):
+    """Volumen a una escala: filas proporcionales, recomendaciones con la raíz cuadrada"""
+    return {'filas': int(base['filas'] * scale), 'municipios': base['municipios'],
+            'recomendaciones': max(1, int(round(base['recomendaciones'] * scale ** 0.5)))}
+
+
+def generate_dataset(rows, n_units, n_recommendations, seed=0):
+    """Dataset sintético con el esquema de la app; los textos se comparten entre filas como tras un merge"""
+    rng = np.random.default_rng(seed)
+    n_sentences = max(1, rows // ROWS_PER_SENTENCE)
+    rows = n_sentences * ROWS_PER_SENTENCE
+
+    # Oraciones ordenadas por municipio; párrafos y páginas consecutivos dentro de cada municipio
+    sentence_unit = np.sort(rng.integers(0, n_units, n_sentences))
+    first_sentence = np.searchsorted(sentence_unit, np.arange(n_units))
+    within_unit = np.arange(n_sentences) - first_sentence[sentence_unit]
+    sentence_paragraph = within_unit // SENTENCES_PER_PARAGRAPH
+    # Identificador global de párrafo: cambia con el municipio o con el párrafo dentro del municipio
+    new_paragraph = (np.diff(sentence_unit) != 0) | (np.diff(sentence_paragraph) != 0)
+    paragraph_id = np.concatenate([[0], np.cumsum(new_paragraph)])
+
+    sentence_texts = np.array([f"Oración {i}: {FILLER[:140]}" for i in range(n_sentences)], dtype=object)
+    paragraph_texts = np.array([f"Párrafo {p}: {FILLER[:600]}" for p in range(paragraph_id[-1] + 1)], dtype=object)
+
+    sentence = np.repeat(np.arange(n_sentences), ROWS_PER_SENTENCE)
+    unit = sentence_unit[sentence]
+    rec = rng.integers(0, n_recommendations, rows)
+
+    unit_names = np.array([f"Municipio {u}" for u in range(n_units)], dtype=object)
+    unit_departments = np.array([f"Departamento {u % DEPARTMENTS}" for u in range(n_units)], dtype=object)
+    rec_codes = np.array([f"R{r:04d}" for r in range(n_recommendations)], dtype=object)
+    rec_texts = np.array([f"Recomendación {r}: {FILLER[:200]}" for r in range(n_recommendations)], dtype=object)
+    rec_priority = (np.arange(n_recommendations) % 3 == 0).astype('int64')
+    unit_ipm = rng.uniform(0, 90, n_units).round(2)
+
+    return pd.DataFrame({
+        'mpio': unit_names[unit],
+        'dpto': unit_departments[unit],
+        'recommendation_code': rec_codes[rec],
+        'recommendation_text': rec_texts[rec],
+        'recommendation_topic': np.array(TOPICS, dtype=object)[rec % len(TOPICS)],
+        'recommendation_priority': rec_priority[rec],
+        'recommendation_priority_label': np.where(rec_priority[rec] == 1, 'Alta', 'Baja').astype(object),
+        'sentence_text': sentence_texts[sentence],
+        'sentence_similarity': rng.beta(4, 4, rows),
+        'paragraph_text': paragraph_texts[paragraph_id[sentence]],
+        'paragraph_similarity': rng.beta(4, 4, rows),
+        'paragraph_id': paragraph_id[sentence],
+        'page_number': sentence_paragraph[sentence] // PARAGRAPHS_PER_PAGE + 1,
+        'predicted_class': np.where(rng.random(rows) < 0.7, 'Incluida', 'Excluida').astype(object),
+        'prediction_confidence': rng.uniform(0.5, 1.0, rows),
+        'IPM_2018': unit_ipm[unit],
+        'PDET': (unit % 6 == 0).astype('int64'),
+        'Cat_IICA': np.array(['Bajo', 'Medio', 'Alto', 'Muy Alto'], dtype=object)[unit % 4],
+        'Grupo_MDM': np.array(['C', 'G1', 'G2', 'G3', 'G4', 'G5'], dtype=object)[unit % 6],
+        'sentence_id': sentence,
+        'sentence_id_paragraph': within_unit[sentence] % SENTENCES_PER_PARAGRAPH,
+    })
+
+
+def timed(timings, operation, function, *args):
+    """Ejecutar una operación y agregar su duración"""
+    start = time.perf_counter()
+    result = function(*args)
+    timings.setdefault(operation, []).append(time.perf_counter() - start)
+    return result
+
+
+def measure(data_path, repetitions, seed):
+    """Medir las operaciones clave de la app sobre un dataset (se ejecuta en un proceso aparte)"""
+    import app_mpios_priorizados as app
+
+    cutoff = app.POLICY_CONFIDENCE_CUTOFF
+    timings = {}
+    rss = {'inicio': peak_rss_mb()}
+
+    df = timed(timings, 'carga', app.load_data, data_path, cutoff)
+    rss['carga'] = peak_rss_mb()
+
+    def precompute():
+        app.load_policy_positions(data_path, cutoff)
+        app.load_implementation_kpis(data_path, cutoff)
+        return app.load_similarity_histograms(data_path, cutoff)
+    histograms = timed(timings, 'precalculo', precompute)
+    rss['precalculo'] = peak_rss_mb()
+
+    def filter_rows(department, municipality, threshold):
+        # Mismos filtros que main(): política, departamento y municipio, luego el umbral
+        filtered = app.select_rows(df, True, app.load_policy_positions(data_path, cutoff), department, municipality)
+        return app.filter_by_threshold(filtered, histograms.recommendations, threshold)
+
+    def ficha(units, threshold):
+        kpis = app.load_implementation_kpis(data_path, cutoff)
+        kpis.unit_counts(histograms, units, True, threshold)
+        histograms.counts_at(units, True, threshold)
+        histograms.distribution(units, True)
+        return app.compute_recommendations_dictionary(histograms, units, True)
+
+    rng = np.random.default_rng(seed)
+    # Umbrales distintos en cada repetición (hasta 10): el ranking no sale del caché
+    thresholds = np.resize(rng.permutation(app.SIMILARITY_GRID[8:18]), repetitions)
+    selections = rng.choice(len(histograms.units), size=repetitions)
+    for threshold, position in zip(thresholds, selections):
+        threshold = float(threshold)
+        department = histograms.units['dpto'].iat[position]
+        municipality = histograms.units['mpio'].iat[position]
+
+        timed(timings, 'filtro_general', filter_rows, 'Todos', 'Todos', threshold)
+        selected = timed(timings, 'filtro_municipio', filter_rows, department, municipality, threshold)
+        timed(timings, 'ranking', app.compute_ranking, data_path, cutoff, True, threshold, app.DEFAULT_TIE_METHOD, ())
+        timed(timings, 'ficha', ficha, histograms.unit_positions(department, municipality), threshold)
+
+        ranking_data = app.create_ranking_data(data_path, True, threshold)
+        timed(timings, 'exportar', app.create_export_file, selected, ranking_data,
+              app.create_variable_dictionary(), 'Excel (.xlsx)')
+    rss['operaciones'] = peak_rss_mb()
+
+    # Selección general (sin filtro de lugar) una vez por escala: es la descarga más pesada
+    threshold = float(thresholds[0])
+    general = filter_rows('Todos', 'Todos', threshold)
+    ranking_data = app.create_ranking_data(data_path, True, threshold)
+    dictionary = app.create_variable_dictionary()
+    try:
+        timed(timings, 'excel_general', app.create_export_file, general, ranking_data, dictionary, 'Excel (.xlsx)')
+        excel_exceeded = False
+    except ValueError:
+        # create_export_file rechaza las selecciones que no caben en una hoja
+        if len(general) <= app.EXCEL_MAX_ROWS:
+            raise
+        excel_exceeded = True
+    timed(timings, 'csv_gz_general', app.create_export_file, general, ranking_data, dictionary,
+          'CSV comprimido (.csv.gz)')
+    rss['exportacion_general'] = peak_rss_mb()
+
+    return {
+        'filas': len(df),
+        'municipios': len(histograms.units),
+        'recomendaciones': len(histograms.recommendations),
+        'memoria_dataset_mb': app.memory_usage_mb(df),
+        'operaciones': {operation: {'mediana': float(np.median(values)), 'max': float(np.max(values))}
+                        for operation, values in timings.items()},
+        'filas_seleccion_general': len(general),
+        'excel_excedido': excel_exceeded,
+        'excel_max_filas': app.EXCEL_MAX_ROWS,
+        'rss_pico_mb': rss['exportacion_general'],
+        'rss_por_etapa_mb': rss,
+    }
+
+
+def run_scale(scale, base, args, work_dir):
+    """Generar el dataset de una escala y medirlo en un proceso nuevo"""
+    volume = scaled_volume(base, scale)
+    data_dir = os.path.join(work_dir, f'escala_{scale:g}', 'Data')
+    os.makedirs(data_dir, exist_ok=True)
+    data_path = os.path.join('Data', f'Similitudes sinteticas x{scale:g}.pkl')
+
+    start = time.perf_counter()
+    df = generate_dataset(volume['filas'], volume['municipios'], volume['recomendaciones'], args.semilla)
+    df.to_pickle(os.path.join(data_dir, os.path.basename(data_path)))
+    del df
+    generation = time.perf_counter() - start
+
+    # La app lee Data/ con rutas relativas: cada escala corre en su carpeta, sin artefactos
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--medir', data_path,
+         '--repeticiones', str(args.repeticiones), '--semilla', str(args.semilla)],
+        cwd=os.path.dirname(data_dir), capture_output=True, text=True, timeout=args.timeout)
+    lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if process.returncode != 0 or not lines:
+        raise RuntimeError(f"escala {scale:g}: el proceso de medición falló\n{process.stderr[-2000:]}")
+
+    result = json.loads(lines[-1][len(RESULT_PREFIX):])
+    result.update({'escala': scale, 'generacion_s': generation,
+                   'archivo_mb': os.path.getsize(os.path.join(data_dir, os.path.basename(data_path))) / 1024 ** 2})
+    if not args.conservar:
+        shutil.rmtree(os.path.dirname(data_dir))
+    return result
+
+
+def fit_growth(scales, values):
+    """Exponente b de valor ≈ a·escala^b (ajuste log-log); None con menos de dos escalas"""
+    scales, values = np.asarray(scales, dtype='float64'), np.asarray(values, dtype='float64')
+    valid = (scales > 0) & (values > 0)
+    if valid.sum() < 2 or np.ptp(np.log(scales[valid])) == 0:
+        return None
+    return float(np.polyfit(np.log(scales[valid]), np.log(values[valid]), 1)[0])
+
+
+def breaking_scale(scale, value, exponent, limit):
+    """Escala a la que la curva ajustada alcanza el límite (None si no crece)"""
+    if exponent is None or exponent <= 0.05:
+        return None
+    return scale * (limit / value) ** (1 / exponent)
+
+
+def scaling_curve(results, latency_limits, max_rss_mb):
+    """Exponentes de crecimiento, escala estimada de ruptura y límites superados"""
+    scales = [result['escala'] for result in results]
+    last = results[-1]
+    curve, violations = {}, []
+
+    for operation, limit in latency_limits.items():
+        values = [result['operaciones'].get(operation, {}).get('max', np.nan) for result in results]
+        exponent = fit_growth(scales, values)
+        curve[operation] = {'exponente': exponent, 'limite': limit,
+                            'escala_limite': breaking_scale(last['escala'], values[-1], exponent, limit)}
+        violations += [f"{operation} a {scale:g}×: {value:.3g} s > {limit:g} s"
+                       for scale, value in zip(scales, values) if value > limit]
+
+    # La memoria tiene una base fija (intérprete y librerías): se ajusta una recta
+    rss = [result['rss_pico_mb'] for result in results]
+    slope, intercept = np.polyfit(scales, rss, 1) if len(results) > 1 else (0.0, rss[0])
+    curve['rss_pico'] = {'mb_por_escala': float(slope), 'base_mb': float(intercept), 'limite': max_rss_mb,
+                         'escala_limite': (max_rss_mb - intercept) / slope if slope > 0 else None}
+    violations += [f"memoria pico a {scale:g}×: {value:.0f} MB > {max_rss_mb:g} MB"
+                   for scale, value in zip(scales, rss) if value > max_rss_mb]
+
+    # Las filas de la selección general crecen en proporción a la escala: recta por el origen
+    rows = np.array([result['filas_seleccion_general'] for result in results], dtype='float64')
+    rows_per_scale = float(np.dot(scales, rows) / np.dot(scales, scales))
+    excel_limit = last['excel_max_filas']
+    curve['filas_excel'] = {'filas_por_escala': rows_per_scale, 'limite': excel_limit,
+                            'escala_limite': excel_limit / rows_per_scale if rows_per_scale > 0 else None}
+    violations += [f"excel_general a {result['escala']:g}×: {result['filas_seleccion_general']:,} filas > "
+                   f"{excel_limit:,} (máximo de una hoja de Excel)" for result in results if result['excel_excedido']]
+    return curve, violations
+
+
+def format_reach(scale):
+    if scale is None:
+        return "no crece"
+    return f"> {MAX_REPORTED_SCALE:,}×" if scale > MAX_REPORTED_SCALE else f"~{scale:.0f}×"
+
+
+def print_report(results, curve, violations, latency_limits):
+    operations = list(latency_limits)
+    print(f"\n{'escala':>7}{'filas':>13}{'recs':>7}" + "".join(f"{op[:14]:>16}" for op in operations)
+          + f"{'RSS pico':>11}")
+    for result in results:
+        times = "".join(f"{result['operaciones'].get(op, {}).get('max', float('nan')):>16.3f}" for op in operations)
+        print(f"{result['escala']:>6g}×{result['filas']:>13,}{result['recomendaciones']:>7}{times}"
+              f"{result['rss_pico_mb']:>8.0f} MB")
+
+    print("\nCrecimiento (latencia ≈ escala^b) y escala a la que se alcanza el límite:")
+    for operation in operations:
+        stats = curve[operation]
+        exponent = "n/d" if stats['exponente'] is None else f"{stats['exponente']:.2f}"
+        print(f"  {operation:<18} b={exponent:<6} límite {stats['limite']:g} s -> "
+              f"{format_reach(stats['escala_limite'])}")
+    rss = curve['rss_pico']
+    print(f"  {'memoria pico':<18} {rss['base_mb']:.0f} MB + {rss['mb_por_escala']:.1f} MB por escala, "
+          f"límite {rss['limite']:g} MB -> {format_reach(rss['escala_limite'])}")
+    rows = curve['filas_excel']
+    print(f"  {'filas en Excel':<18} {rows['filas_por_escala']:,.0f} filas por escala en la selección general, "
+          f"límite {rows['limite']:,} -> {format_reach(rows['escala_limite'])}")
+
+    for violation in violations:
+        print(f"LÍMITE SUPERADO {violation}")
+
+
+def save_chart(results, path):
+    """Curva de escalamiento en HTML (latencia por operación y memoria pico, ejes logarítmicos)"""
+    import plotly.express as px
+
+    rows = [{'Escala': result['escala'], 'Operación': operation, 'Segundos': stats['max']}
+            for result in results for operation, stats in result['operaciones'].items()]
+    fig = px.line(pd.DataFrame(rows), x='Escala', y='Segundos', color='Operación', markers=True,
+                  log_x=True, log_y=True, title="Latencia (peor caso) por escala del dataset")
+    fig.add_scatter(x=[result['escala'] for result in results], y=[result['rss_pico_mb'] for result in results],
+                    name='RSS pico (MB)', yaxis='y2', mode='lines+markers', line={'dash': 'dot'})
+    fig.update_layout(yaxis2={'title': 'MB', 'overlaying': 'y', 'side': 'right', 'type': 'log'})
+    fig.write_html(path)
+
+
+def parse_limits(values):
+    """Límites 'operacion=segundos' de la línea de comandos sobre los valores por defecto"""
+    limits = dict(LATENCY_LIMITS)
+    for value in values or []:
+        operation, _, seconds = value.partition('=')
+        if operation not in limits or not seconds:
+            raise SystemExit(f"Límite inválido '{value}'; operaciones: {', '.join(limits)}")
+        limits[operation] = float(seconds)
+    return limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de escalamiento de memoria y latencia con datos sintéticos")
+    parser.add_argument('--escalas', type=float, nargs='+', default=[1, 10, 50], help="Múltiplos del volumen actual")
+    parser.add_argument('--filas-base', type=int, help="Filas del volumen 1× (por defecto, las del dataset actual)")
+    parser.add_argument('--municipios', type=int, help="Municipios del volumen 1×")
+    parser.add_argument('--recomendaciones', type=int, help="Recomendaciones del volumen 1×")
+    parser.add_argument('--repeticiones', type=int, default=5, help="Repeticiones de cada operación interactiva")
+    parser.add_argument('--limite', action='append', metavar='OPERACION=SEGUNDOS',
+                        help=f"Cambiar un límite de latencia ({', '.join(LATENCY_LIMITS)})")
+    parser.add_argument('--max-rss-mb', type=float, default=MAX_RSS_MB, help="Límite de memoria pico por proceso")
+    parser.add_argument('--directorio', help="Carpeta de trabajo para los datasets (por defecto una temporal)")
+    parser.add_argument('--conservar', action='store_true', help="No borrar los datasets generados")
+    parser.add_argument('--timeout', type=float, default=3600, help="Tiempo máximo por escala (s)")
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--json', help="Guardar resultados y curva en este archivo")
+    parser.add_argument('--grafico', help="Guardar la curva de escalamiento en este HTML")
+    parser.add_argument('--medir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        print(RESULT_PREFIX + json.dumps(measure(args.medir, args.repeticiones, args.semilla)))
+        return
+
+    from artefactos import DATA_PATH, artifact_dir_for
+    latency_limits = parse_limits(args.limite)
+    base = dict(current_volume(DATA_PATH, artifact_dir_for(DATA_PATH)) or DEFAULT_VOLUME)
+    for key, value in [('filas', args.filas_base), ('municipios', args.municipios),
+                       ('recomendaciones', args.recomendaciones)]:
+        if value:
+            base[key] = value
+    print(f"Volumen 1×: {base['filas']:,} filas, {base['municipios']} municipios, "
+          f"{base['recomendaciones']} recomendaciones")
+
+    work_dir = args.directorio or tempfile.mkdtemp(prefix='escalamiento_')
+    results = []
+    try:
+        for scale in sorted(args.escalas):
+            result = run_scale(scale, base, args, work_dir)
+            results.append(result)
+            print(f"{scale:g}×: {result['filas']:,} filas ({result['archivo_mb']:.0f} MB) medidas, "
+                  f"RSS pico {result['rss_pico_mb']:.0f} MB")
+    finally:
+        if not args.directorio and not args.conservar:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    curve, violations = scaling_curve(results, latency_limits, args.max_rss_mb)
+    print_report(results, curve, violations, latency_limits)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'volumen_base': base, 'resultados': results, 'curva': curve, 'limites_superados': violations},
+                      f, ensure_ascii=False, indent=2)
+    if args.grafico:
+        save_chart(results, args.grafico)
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
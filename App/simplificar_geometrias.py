@@ -0,0 +1,117 @@
+"""Preparar los límites municipales que usa el mapa de la app.
+
+Lee un GeoJSON de municipios (p. ej. el MGN del DANE), simplifica cada anillo con
+Douglas-Peucker, redondea las coordenadas y guarda un GeoJSON compacto cuyas
+features tienen como `id` la llave departamento|municipio que usa la app.
+
+Uso (desde la raíz del repositorio):
+    python App/simplificar_geometrias.py MGN_MPIO_POLITICO.geojson
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from lugares import GEOMETRY_PATH, place_key
+
+
+def douglas_peucker(points, tolerance):
+    """Índices de los puntos que se conservan al simplificar una línea"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        segment = points[end] - points[start]
+        inner = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+
+    return keep
+
+
+def simplify_ring(ring, tolerance, decimals):
+    """Simplificar un anillo cerrado; devuelve None si queda degenerado"""
+    points = np.asarray(ring, dtype='float64')[:, :2]
+    simplified = np.round(points[douglas_peucker(points, tolerance)], decimals)
+
+    # Quitar puntos repetidos que aparecen al redondear
+    changed = np.any(np.diff(simplified, axis=0) != 0, axis=1)
+    simplified = simplified[np.concatenate([[True], changed])]
+    if len(simplified) < 4:
+        return None
+    return simplified.tolist()
+
+
+def simplify_geometry(geometry, tolerance, decimals):
+    """Simplificar un Polygon o MultiPolygon conservando solo polígonos válidos"""
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+
+    simplified = []
+    for polygon in polygons:
+        rings = [simplify_ring(ring, tolerance, decimals) for ring in polygon]
+        # Sin anillo exterior el polígono se descarta; los huecos degenerados se omiten
+        if rings and rings[0] is not None:
+            simplified.append([ring for ring in rings if ring is not None])
+
+    if not simplified:
+        return None
+    if len(simplified) == 1:
+        return {'type': 'Polygon', 'coordinates': simplified[0]}
+    return {'type': 'MultiPolygon', 'coordinates': simplified}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simplificar límites municipales para el mapa de la app")
+    parser.add_argument('entrada', help="GeoJSON de municipios")
+    parser.add_argument('--salida', default=GEOMETRY_PATH, help=f"Archivo de salida (por defecto {GEOMETRY_PATH})")
+    parser.add_argument('--campo-departamento', default='DPTO_CNMBR', help="Propiedad con el nombre del departamento")
+    parser.add_argument('--campo-municipio', default='MPIO_CNMBR', help="Propiedad con el nombre del municipio")
+    parser.add_argument('--tolerancia', type=float, default=0.005,
+                        help="Tolerancia de simplificación en grados (0.005 ≈ 500 m)")
+    parser.add_argument('--decimales', type=int, default=4, help="Decimales de las coordenadas")
+    args = parser.parse_args()
+
+    with open(args.entrada, encoding='utf-8') as f:
+        source = json.load(f)
+
+    features = []
+    for feature in source['features']:
+        properties = feature['properties']
+        geometry = simplify_geometry(feature['geometry'], args.tolerancia, args.decimales)
+        if geometry is None:
+            continue
+        features.append({
+            'type': 'Feature',
+            'id': place_key(properties[args.campo_departamento], properties[args.campo_municipio]),
+            'properties': {
+                'dpto': properties[args.campo_departamento],
+                'mpio': properties[args.campo_municipio],
+            },
+            'geometry': geometry,
+        })
+
+    os.makedirs(os.path.dirname(args.salida) or '.', exist_ok=True)
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f, ensure_ascii=False, separators=(',', ':'))
+
+    print(f"{len(features)} municipios -> {args.salida} ({os.path.getsize(args.salida) / 1024 ** 2:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()